@@ -0,0 +1,324 @@
+"""
+Benchmarks for the CSV persistence path of pidata-speedtest.py.
+
+Builds synthetic result logs of each requested size and times write_csv on
+them: cold appends (fresh process state, as under cron), warm appends (header
+already checked), appends that trigger the header migration, and concurrent
+appends from several processes. The stress scenario has all writers start at
+once on a log that needs the header migration, with rollups on; the rotate
+scenario does the same with the log rotating into gzip segments every
+quarter of the appends. The concurrent scenarios then check that every row
+arrived exactly once and intact, across segments, and that the index and
+rollups agree with the log; the run fails if not. Every scenario runs in
+its own worker process so the reported peak RSS belongs to that scenario
+alone; for the concurrent ones it is the largest of the writer processes.
+
+    python pidata-speedtest-bench.py --sizes 1k,100k,1M --json bench.json
+
+--startup instead times `pidata-speedtest.py --help` and fails when its median
+wall time exceeds the budget or, under python -X importtime, it imports a
+module that must stay lazy.
+"""
+import argparse
+import concurrent.futures
+import csv
+import importlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SCENARIOS = ["cold", "warm", "migrate", "concurrent", "stress", "rotate"]
+CONCURRENT_SCENARIOS = ("concurrent", "stress", "rotate")
+# modules only the measurement and storage paths may import
+LAZY_MODULES = ["speedtest", "sqlite3", "pyarrow", "numpy", "concurrent.futures", "http.server"]
+
+def load_app():
+    """Import pidata_speedtest, the module behind pidata-speedtest.py."""
+    if HERE not in sys.path:
+        sys.path.insert(0, HERE)
+    return importlib.import_module("pidata_speedtest")
+
+def parse_size(text):
+    text = text.strip().lower()
+    scale = {"k": 1_000, "m": 1_000_000}.get(text[-1:], 1)
+    return int(float(text.rstrip("km")) * scale)
+
+def sample_row(fieldnames, i):
+    row = {
+        "device": ("TUCMOTO5", "TUCMOTO2", "ZyXEL20522")[i % 3],
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(1_700_000_000 + i * 300)) + ".000000Z",
+        "server_id": str(10000 + i % 50), "server_name": "Tucson, AZ", "sponsor": "Example ISP",
+        "country": "United States", "host": "speedtest.example.net:8080", "lat": "32.2217", "lon": "-110.9265",
+        "ping_ms": "%.3f" % (10 + i % 17), "download_mbps": "%.3f" % (300 + i % 97),
+        "upload_mbps": "%.3f" % (20 + i % 13), "client_ip": "203.0.113.7", "client_isp": "Example ISP",
+    }
+    return {fn: row.get(fn, "") for fn in fieldnames}
+
+def make_log(path, rows, fieldnames):
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames)
+        writer.writeheader()
+        batch = []
+        for i in range(rows):
+            batch.append(sample_row(fieldnames, i))
+            if len(batch) == 10_000:
+                writer.writerows(batch)
+                batch.clear()
+        writer.writerows(batch)
+
+def copy_log(src, dst):
+    """Copy a log and its sidecar index."""
+    shutil.copyfile(src, dst)
+    if os.path.exists(src + ".idx"):
+        shutil.copyfile(src + ".idx", dst + ".idx")
+
+def percentile(sorted_values, p):
+    """Linear-interpolated percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    k = (len(sorted_values) - 1) * p / 100
+    lo = int(k)
+    hi = min(lo + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024 if sys.platform == "darwin" else 1024)
+
+def _timed_appends(app, path, count, first, cold, rollups=False, rotate=None):
+    latencies = []
+    for i in range(count):
+        if cold:
+            app._header_cache.clear()
+            app._index_cache.clear()
+        row = sample_row(app.FIELDNAMES, first + i)
+        t0 = time.perf_counter()
+        app.write_csv(path, row, app.FIELDNAMES, rollups, rotate)
+        latencies.append(time.perf_counter() - t0)
+    return latencies
+
+def _concurrent_writer(path, count, first, start_at, rollups=False, rotate=None):
+    app = load_app()
+    # line the writers up so process startup isn't part of the measurement
+    time.sleep(max(0.0, start_at - time.time()))
+    latencies = _timed_appends(app, path, count, first, cold=False, rollups=rollups, rotate=rotate)
+    # the appends happen here, not in the coordinating process
+    return latencies, time.time(), peak_rss_mb()
+
+def check_log(app, path, total, rollups=False):
+    """
+    Check a log that should hold the sample rows 0..total-1 after concurrent
+    appends, in its rotated segments too; returns a list of problems, empty
+    when it is intact.
+    """
+    problems = []
+    seen = {}
+    for _, segment in app.log_segments(path) + [(None, path)]:
+        with app._open_segment(segment) as f:
+            reader = app._read_rows(f)
+            header = next(reader)
+            # a segment may have been closed before its header was migrated
+            if segment == path and header[:len(app.FIELDNAMES)] != app.FIELDNAMES:
+                problems.append(f"header is {header}")
+            for line, fields in enumerate(reader, 2):
+                if len(fields) != len(header):
+                    problems.append(f"{os.path.basename(segment)} line {line} has {len(fields)} fields, not {len(header)}")
+                    continue
+                ts = fields[header.index("timestamp")]
+                seen[ts] = seen.get(ts, 0) + 1
+    expected = {sample_row(["timestamp"], i)["timestamp"] for i in range(total)}
+    lost = len(expected - set(seen))
+    duplicated = sum(n - 1 for n in seen.values() if n > 1)
+    if lost or duplicated or len(seen) != total:
+        problems.append(f"{lost} rows lost, {duplicated} duplicated, {len(seen)} distinct of {total}")
+    index = app._read_csv_index(path)
+    app._rebuild_csv_index(path)
+    if index != app._read_csv_index(path):
+        problems.append("sidecar index differs from a rebuilt one")
+    if rollups:
+        counted = sum(r["count"] for r in app.read_rollups(path) if r["metric"] == "download_mbps")
+        if counted != total:
+            problems.append(f"rollups count {counted} rows, not {total}")
+    return problems
+
+def run_scenario(scenario, base_log, rows, appends, writers, workdir):
+    """Run one scenario against a private copy of base_log; returns a result dict."""
+    app = load_app()
+    path = os.path.join(workdir, f"{scenario}-{rows}.csv")
+    latencies = []
+    peak_rss = None
+    if scenario in ("cold", "warm"):
+        copy_log(base_log, path)
+        latencies = _timed_appends(app, path, appends, rows, cold=scenario == "cold")
+    elif scenario == "migrate":
+        # every sample needs a log whose header lacks 'device'
+        legacy = [fn for fn in app.FIELDNAMES if fn != "device"]
+        for i in range(appends):
+            make_log(path, rows, legacy)
+            latencies += _timed_appends(app, path, 1, rows + i, cold=True)
+    elif scenario in CONCURRENT_SCENARIOS:
+        stress = scenario in ("stress", "rotate")
+        if stress:
+            # the first writer in migrates the header while the others queue
+            make_log(path, rows, [fn for fn in app.FIELDNAMES if fn != "device"])
+        else:
+            copy_log(base_log, path)
+        per_writer = max(1, appends // writers)
+        rotate = None
+        if scenario == "rotate":
+            # the legacy log is closed on the first append, then about every quarter of the appends
+            rotate = max(1, os.path.getsize(path) // max(1, rows)) * max(1, per_writer * writers // 4)
+        start_at = time.time() + 1.0
+        finished = start_at
+        with concurrent.futures.ProcessPoolExecutor(max_workers=writers) as pool:
+            futures = [pool.submit(_concurrent_writer, path, per_writer, rows + w * per_writer, start_at, stress, rotate)
+                       for w in range(writers)]
+            for fut in futures:
+                worker_latencies, worker_end, worker_rss = fut.result()
+                latencies += worker_latencies
+                finished = max(finished, worker_end)
+                if worker_rss is not None:
+                    peak_rss = max(peak_rss or 0.0, worker_rss)
+        problems = check_log(app, path, rows + writers * per_writer, rollups=stress)
+    elapsed = finished - start_at if scenario in CONCURRENT_SCENARIOS else sum(latencies)
+    latencies.sort()
+    result = {
+        "scenario": scenario,
+        "rows": rows,
+        "appends": len(latencies),
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "max_ms": latencies[-1] * 1000,
+        "throughput_rows_s": len(latencies) / elapsed if elapsed else None,
+        "peak_rss_mb": peak_rss if scenario in CONCURRENT_SCENARIOS else peak_rss_mb(),
+        "problems": problems if scenario in CONCURRENT_SCENARIOS else [],
+    }
+    segments = [segment for _, segment in app.log_segments(path)]
+    for p in [path, path + ".idx", path + ".lock"] + segments + [app._segment_latest_path(seg) for seg in segments]:
+        if os.path.exists(p):
+            os.remove(p)
+    shutil.rmtree(path + ".rollups", ignore_errors=True)
+    return result
+
+def parse_importtime(stderr):
+    """Return {module: cumulative_us} for the top-level imports in -X importtime output."""
+    imports = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if cumulative.strip().isdigit():
+            imports[name.strip()] = int(cumulative)
+    return imports
+
+def bench_startup(runs, budget_ms, argv=("--help",)):
+    """Time the CLI startup and check it against the budget; returns (result, problems)."""
+    script = os.path.join(HERE, "pidata-speedtest.py")
+    # as deployed: the module's bytecode is cached after the first launch
+    env = {k: v for k, v in os.environ.items() if k != "PYTHONDONTWRITEBYTECODE"}
+    subprocess.run([sys.executable, script, *argv], capture_output=True, stdin=subprocess.DEVNULL, env=env)
+    walls = []
+    for _ in range(runs):
+        t0 = time.perf_counter()
+        subprocess.run([sys.executable, script, *argv], capture_output=True, stdin=subprocess.DEVNULL, env=env)
+        walls.append(time.perf_counter() - t0)
+    # -X importtime slows the launch down, so it gets a run of its own
+    proc = subprocess.run([sys.executable, "-X", "importtime", script, *argv],
+                          capture_output=True, text=True, stdin=subprocess.DEVNULL, env=env)
+    imports = parse_importtime(proc.stderr)
+    walls.sort()
+    result = {
+        "scenario": "startup",
+        "argv": list(argv),
+        "runs": runs,
+        "p50_ms": percentile(walls, 50) * 1000,
+        "p95_ms": percentile(walls, 95) * 1000,
+        "import_ms": sum(us for name, us in imports.items() if not name.startswith(" ")) / 1000,
+        "slowest_imports": sorted(((us / 1000, name) for name, us in imports.items() if not name.startswith(" ")), reverse=True)[:5],
+    }
+    problems = [f"imports {m} on startup" for m in LAZY_MODULES if m in {n.strip() for n in imports}]
+    if result["p50_ms"] > budget_ms:
+        problems.append(f"startup takes {result['p50_ms']:.1f} ms, budget is {budget_ms:g} ms")
+    return result, problems
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the CSV persistence path of pidata-speedtest.py.")
+    parser.add_argument("--sizes", default="1k,10k,100k,1M,10M", help="Comma-separated log sizes in rows (default: 1k,10k,100k,1M,10M)")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help=f"Comma-separated scenarios (default: {','.join(SCENARIOS)})")
+    parser.add_argument("--appends", type=int, default=200, help="Appends timed per scenario (default: 200)")
+    parser.add_argument("--migrations", type=int, default=3, help="Header migrations timed per size (default: 3)")
+    parser.add_argument("--writers", type=int, default=8, help="Processes in the concurrent scenario (default: 8)")
+    parser.add_argument("--dir", help="Scratch directory for the generated logs (default: a temporary directory)")
+    parser.add_argument("--json", help="Also write the results as JSON to this path")
+    parser.add_argument("--startup", action="store_true", help="Benchmark CLI startup (--help) instead of the CSV path")
+    parser.add_argument("--startup-runs", type=int, default=10, help="CLI launches timed by --startup (default: 10)")
+    parser.add_argument("--startup-budget-ms", type=float, default=100, help="Max median wall time of --help in ms before --startup fails (default: 100)")
+    args = parser.parse_args()
+
+    if args.startup:
+        result, problems = bench_startup(args.startup_runs, args.startup_budget_ms)
+        print(f"startup p50 {result['p50_ms']:.1f} ms, p95 {result['p95_ms']:.1f} ms, imports {result['import_ms']:.1f} ms")
+        for ms, name in result["slowest_imports"]:
+            print(f"  {ms:8.1f} ms  {name}")
+        if args.json:
+            with open(args.json, "w", encoding="utf-8") as f:
+                json.dump([result], f, indent=2)
+        for p in problems:
+            print(f"FAIL: {p}")
+        sys.exit(1 if problems else 0)
+
+    scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenario(s): {', '.join(sorted(unknown))}")
+    sizes = [parse_size(s) for s in args.sizes.split(",") if s.strip()]
+
+    app = load_app()
+    workdir = args.dir or tempfile.mkdtemp(prefix="pidata-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    results = []
+    print(f"{'scenario':<11}{'rows':>10}{'n':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}{'rows/s':>11}{'RSS MB':>9}")
+    try:
+        for rows in sizes:
+            base_log = os.path.join(workdir, f"base-{rows}.csv")
+            make_log(base_log, rows, app.FIELDNAMES)
+            # logs written by the app carry an index; a missing one is rebuilt on the first append
+            app._rebuild_csv_index(base_log)
+            for scenario in scenarios:
+                appends = args.migrations if scenario == "migrate" else args.appends
+                # a fresh process per scenario keeps peak RSS figures separate
+                with concurrent.futures.ProcessPoolExecutor(max_workers=1) as pool:
+                    r = pool.submit(run_scenario, scenario, base_log, rows, appends, args.writers, workdir).result()
+                results.append(r)
+                rss = f"{r['peak_rss_mb']:.1f}" if r["peak_rss_mb"] is not None else "n/a"
+                print(f"{r['scenario']:<11}{r['rows']:>10}{r['appends']:>6}{r['p50_ms']:>10.3f}{r['p95_ms']:>10.3f}"
+                      f"{r['p99_ms']:>10.3f}{r['max_ms']:>10.3f}{r['throughput_rows_s']:>11.0f}{rss:>9}", flush=True)
+                for p in r["problems"]:
+                    print(f"FAIL: {r['scenario']} at {rows} rows: {p}", flush=True)
+            os.remove(base_log)
+            os.remove(base_log + ".idx")
+    finally:
+        if not args.dir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    sys.exit(1 if any(r["problems"] for r in results) else 0)
+
+if __name__ == "__main__":
+    main()
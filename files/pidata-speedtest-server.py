@@ -0,0 +1,186 @@
+"""
+Local stand-in for the speedtest.net infrastructure.
+
+Serves the config, server list, latency, download and upload endpoints the
+speedtest module talks to, with optional bandwidth and latency shaping, so
+pidata-speedtest.py can be run and timed on loopback. It also answers
+proxy-style requests, which is how the hard-coded speedtest.net URLs reach it:
+
+    python pidata-speedtest-server.py --port 8080 --bandwidth 100 --latency 20
+    http_proxy=http://127.0.0.1:8080 python pidata-speedtest.py -d TUCMOTO5 -o /tmp/results.csv
+"""
+import argparse
+import re
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+RANDOM_RE = re.compile(r"/random(\d+)x\d+\.jpg$")
+# pattern the speedtest module uploads; downloads reuse it as filler
+PAYLOAD = b"0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ" * 1820  # ~64 KiB
+CHUNK = len(PAYLOAD)
+
+CONFIG_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<settings>
+<client ip="127.0.0.1" lat="32.2217" lon="-110.9265" isp="Loopback" isprating="3.7" rating="0" ispdlavg="0" ispulavg="0" loggedin="0" country="US" />
+<server-config threadcount="{threads}" ignoreids="" notonmap="" forcepingid="" preferredserverid=""/>
+<download testlength="{length}" initialtest="250K" mintestsize="250K" threadsperurl="4"/>
+<upload testlength="{length}" ratio="5" initialtest="0" mintestsize="32K" threads="2" maxchunksize="512K" maxchunkcount="50" threadsperurl="4"/>
+<latency testlength="10" waittime="50" timeout="20"/>
+</settings>
+"""
+
+SERVER_XML = """<server url="http://{host}/s{id}/speedtest/upload.php" lat="{lat:.4f}" lon="-110.9265" name="Loopback {id}" country="United States" cc="US" sponsor="pidata stand-in" id="{id}" host="{host}"/>"""
+
+class TokenBucket:
+    """Shared byte budget refilled at rate_mbps; None means unlimited."""
+
+    def __init__(self, rate_mbps=None):
+        self.rate = rate_mbps * 1_000_000 / 8 if rate_mbps else None
+        self.tokens = 0.0
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, n):
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            # allow at most 50 ms worth of burst
+            self.tokens = min(self.tokens + (now - self.stamp) * self.rate, self.rate * 0.05)
+            self.stamp = now
+            self.tokens -= n
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+class StandInHandler(BaseHTTPRequestHandler):
+    # keep-alive, so a client can reuse a connection for latency probes
+    protocol_version = "HTTP/1.1"
+    server_version = "pidata-speedtest-standin"
+
+    def setup(self):
+        super().setup()
+        # headers and body go out in separate writes; don't let Nagle hold
+        # the body back for a delayed ACK on keep-alive connections
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _send_body(self, body, content_type="text/plain"):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _delay(self):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+    def do_GET(self):
+        # proxied requests carry the absolute URL
+        path = urlsplit(self.path).path
+        self._delay()
+        if path.endswith("/speedtest-config.php"):
+            body = CONFIG_XML.format(threads=self.server.threads, length=self.server.test_length)
+            self._send_body(body.encode(), "text/xml")
+        elif "/speedtest-servers" in path:
+            host = "%s:%d" % self.server.server_address[:2]
+            servers = "\n".join(SERVER_XML.format(host=host, id=i, lat=32.2217 + i / 100)
+                                for i in range(1, self.server.server_count + 1))
+            self._send_body(f'<?xml version="1.0" encoding="UTF-8"?>\n<settings><servers>\n{servers}\n</servers></settings>\n'.encode(), "text/xml")
+        elif path.endswith("/latency.txt"):
+            self._send_body(b"test=test")
+        elif RANDOM_RE.search(path):
+            self._send_random(int(RANDOM_RE.search(path).group(1)))
+        else:
+            self.send_error(404)
+
+    def _send_random(self, side):
+        # roughly the size of the real speedtest.net images
+        remaining = side * side * 2
+        self.send_response(200)
+        self.send_header("Content-Type", "image/jpeg")
+        self.send_header("Content-Length", str(remaining))
+        self.end_headers()
+        view = memoryview(PAYLOAD)
+        try:
+            while remaining:
+                n = min(remaining, CHUNK)
+                self.server.download_bucket.consume(n)
+                self.wfile.write(view[:n])
+                remaining -= n
+        except (BrokenPipeError, ConnectionResetError):
+            # clients hang up once their test length is reached
+            self.close_connection = True
+
+    def do_POST(self):
+        path = urlsplit(self.path).path
+        if not re.search(r"/upload\.\w+$", path):
+            self.send_error(404)
+            return
+        remaining = int(self.headers.get("Content-Length") or 0)
+        received = 0
+        try:
+            while remaining:
+                chunk = self.rfile.read(min(remaining, CHUNK))
+                if not chunk:
+                    break
+                self.server.upload_bucket.consume(len(chunk))
+                received += len(chunk)
+                remaining -= len(chunk)
+        except ConnectionResetError:
+            self.close_connection = True
+            return
+        self._delay()
+        self._send_body(f"size={received}".encode())
+
+def start_server(host="127.0.0.1", port=0, bandwidth=None, latency_ms=0, server_count=3,
+                 threads=4, test_length=10, verbose=False):
+    """
+    Start the stand-in on a background thread and return the server; its
+    address is server.server_address and server.shutdown() stops it.
+    bandwidth is the shared limit per direction in Mbps (None for unlimited).
+    """
+    server = ThreadingHTTPServer((host, port), StandInHandler)
+    server.daemon_threads = True
+    server.download_bucket = TokenBucket(bandwidth)
+    server.upload_bucket = TokenBucket(bandwidth)
+    server.latency = latency_ms / 1000
+    server.server_count = server_count
+    server.threads = threads
+    server.test_length = test_length
+    server.verbose = verbose
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a local speedtest.net stand-in for benchmarks and tests.")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on (default: 127.0.0.1)")
+    parser.add_argument("--port", "-p", type=int, default=8080, help="Port to listen on (default: 8080)")
+    parser.add_argument("--bandwidth", type=float, help="Bandwidth limit per direction in Mbps (default: unlimited)")
+    parser.add_argument("--latency", type=float, default=0, help="Delay added to every response, in ms (default: 0)")
+    parser.add_argument("--servers", type=int, default=3, help="Number of test servers to advertise (default: 3)")
+    parser.add_argument("--threads", type=int, default=4, help="Thread count advertised in the config (default: 4)")
+    parser.add_argument("--test-length", type=int, default=10, help="Download/upload test length in seconds advertised in the config (default: 10)")
+    parser.add_argument("--verbose", "-v", action="store_true", help="Log every request")
+    args = parser.parse_args()
+
+    server = start_server(args.host, args.port, args.bandwidth, args.latency, args.servers,
+                          args.threads, args.test_length, args.verbose)
+    host, port = server.server_address[:2]
+    print(f"Serving speedtest stand-in on {host}:{port}")
+    print(f"Point clients at it with http_proxy=http://{host}:{port}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
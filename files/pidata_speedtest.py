@@ -0,0 +1,3000 @@
+import argparse
+import collections
+import contextlib
+import csv
+import io
+import itertools
+import json
+import math
+import os
+import re
+import sys
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from urllib.parse import quote, unquote, urlsplit
+# speedtest, asyncio, sqlite3, random, concurrent.futures, http.server, gzip and zstandard are
+# imported where they are used, so --help, argument errors and the device prompt start fast
+
+DEFAULT_OUTPUT = r"C:\logs\speedtest\speedtest_results.csv"
+
+FIELDNAMES = [
+    "device", "timestamp", "server_id", "server_name", "sponsor", "country", "host", "lat", "lon",
+    "ping_ms", "download_mbps", "upload_mbps", "client_ip", "client_isp"
+]
+
+# optional per-run profile: wall and CPU seconds per phase, bytes moved and
+# transfer threads; the config phase is empty when a client is reused
+TIMING_FIELDS = [
+    "config_s", "config_cpu_s", "server_s", "server_cpu_s", "download_s", "download_cpu_s",
+    "upload_s", "upload_cpu_s", "bytes_received", "bytes_sent", "download_threads", "upload_threads"
+]
+
+# with --converge or --max-bytes, why each direction ended: "converged", "bytes"
+# (budget spent) or "full" (ran its payloads or --duration); stored with the
+# bytes actually moved
+EARLY_STOP_FIELDS = ["bytes_received", "bytes_sent", "download_stop", "upload_stop"]
+
+# --latency-only rows: probes sent and lost, and round-trip statistics in ms;
+# jitter is the mean difference between consecutive round trips
+LATENCY_FIELDS = [
+    "latency_samples", "latency_lost", "latency_loss_pct", "latency_min_ms", "latency_avg_ms", "latency_max_ms",
+    "latency_jitter_ms", "latency_p50_ms", "latency_p95_ms", "latency_p99_ms"
+]
+
+# how long a cached server list is trusted, in seconds
+SERVER_CACHE_TTL = 24 * 3600
+# the cached best server is re-chosen once its latency exceeds
+# cached * SERVER_CACHE_DRIFT + SERVER_CACHE_DRIFT_MS
+SERVER_CACHE_DRIFT = 2.0
+SERVER_CACHE_DRIFT_MS = 10.0
+# latency speedtest reports when every probe of a server failed
+UNREACHABLE_MS = 1_800_000
+
+# image side lengths speedtest.net servers host as random{N}x{N}.jpg
+DOWNLOAD_SIZES = [350, 500, 750, 1000, 1500, 2000, 2500, 3000, 3500, 4000]
+# --pre-allocate auto builds the upload payloads up front when they fit in this many bytes
+PRE_ALLOCATE_BUDGET = 64 * 1024 * 1024
+# --autotune doubles the transfer threads, running AUTOTUNE_TRIAL_S second
+# trials, while throughput grows by at least AUTOTUNE_GAIN
+AUTOTUNE_TRIAL_S = 2.0
+AUTOTUNE_GAIN = 1.1
+# --converge judges throughput on CONVERGE_WINDOW_S second windows, ignoring
+# the first CONVERGE_WARMUP_S seconds of each direction (connection set-up and
+# TCP slow start), and stops once the 95% confidence interval of the window
+# mean has narrowed to the given share of it, over at least CONVERGE_MIN_WINDOWS
+CONVERGE_WARMUP_S = 1.0
+CONVERGE_WINDOW_S = 0.5
+CONVERGE_MIN_WINDOWS = 4
+# --latency-only probes that take longer than this many seconds count as lost
+LATENCY_TIMEOUT = 2.0
+
+def _load_server_cache(path, key):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f).get(key)
+    except (OSError, ValueError, AttributeError):
+        return None  # missing or corrupt cache is just a miss
+
+def _save_server_cache(path, key, entry):
+    """
+    Store entry under key in the server cache at path, keeping the other
+    keys. Runs and --all-devices workers may share the cache, so the
+    read-modify-write holds lock_file(path) and replaces the file atomically.
+    """
+    try:
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder, exist_ok=True)
+        with lock_file(path):
+            try:
+                with open(path, encoding="utf-8") as f:
+                    cache = json.load(f)
+                if not isinstance(cache, dict):
+                    cache = {}
+            except (OSError, ValueError):
+                cache = {}
+            cache[key] = entry
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(cache, f)
+            os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"Could not update server cache: {e}")
+
+def select_server(s, cache_path=None, ttl=SERVER_CACHE_TTL, key=""):
+    """
+    Choose the test server for s, like s.get_best_server(), but reuse the
+    server list and best server cached in cache_path (under key, e.g. the
+    source address) while they are younger than ttl seconds. A fresh cache
+    costs one latency probe of the cached best server; if that server has
+    become slower, the cached closest servers are re-pinged instead, and
+    only an expired cache downloads the full server list again.
+    """
+    import speedtest
+
+    entry = _load_server_cache(cache_path, key) if cache_path and ttl > 0 else None
+    if entry and time.time() - entry.get("saved_at", 0) < ttl:
+        try:
+            cached_latency = float(entry["best"]["latency"])
+            best = s.get_best_server([dict(entry["best"])])
+            if best["latency"] <= cached_latency * SERVER_CACHE_DRIFT + SERVER_CACHE_DRIFT_MS:
+                return best
+            best = s.get_best_server([dict(c) for c in entry["closest"]])
+        except (KeyError, TypeError, ValueError, speedtest.SpeedtestBestServerFailure):
+            pass  # unusable entry, rediscover below
+        else:
+            if best["latency"] < UNREACHABLE_MS:
+                _save_server_cache(cache_path, key, {**entry, "best": best})
+                return best
+        del s.closest[:]  # don't let discovery start from the cached servers
+
+    best = s.get_best_server()
+    if cache_path and ttl > 0:
+        _save_server_cache(cache_path, key, {"saved_at": time.time(), "closest": s.closest, "best": best})
+    return best
+
+@contextlib.contextmanager
+def _phase(timings, name):
+    """Record wall and CPU seconds of the enclosed block as <name>_s and <name>_cpu_s."""
+    if timings is None:
+        yield
+        return
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield
+    finally:
+        timings[f"{name}_s"] = round(time.perf_counter() - wall, 3)
+        timings[f"{name}_cpu_s"] = round(time.process_time() - cpu, 3)
+
+def _transfer_bytes(t):
+    """Bytes moved so far by a speedtest download or upload worker thread."""
+    if isinstance(t.result, list):  # downloads keep a list of chunk sizes
+        return sum(t.result)
+    return sum(t.request.data.total)
+
+# byte counters of the sampled transfers, and how many of them need the
+# counting worker classes in speedtest, with the original classes
+_counting_lock = threading.Lock()
+_byte_counters = []
+_counting_users = [0, {}]
+
+def _counting_worker(base):
+    """Subclass of a speedtest worker thread class whose instances register with the byte counters as they are built."""
+
+    class CountingWorker(base):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            with _counting_lock:
+                counters = list(_byte_counters)
+            for add in counters:
+                add(self)
+
+    CountingWorker.__name__ = CountingWorker.__qualname__ = f"Counting{base.__name__}"
+    return CountingWorker
+
+@contextlib.contextmanager
+def _worker_byte_counter(direction, url_prefix=""):
+    """
+    Yield a function summing the bytes moved so far by the speedtest
+    download or upload workers talking to URLs under url_prefix that are
+    built while the block runs. The speedtest callbacks only fire when a
+    request starts or ends, so speedtest builds its workers from subclasses
+    that hand each one to the counters; a worker that starts and finishes
+    between two samples still counts. Safe for transfers running in
+    several threads.
+    """
+    import speedtest
+
+    name = "HTTPDownloader" if direction == "download" else "HTTPUploader"
+    workers = []
+    finals = {}  # worker -> its byte count once it has finished
+
+    def add(worker):
+        if isinstance(worker, _counting_users[1][name]) and worker.request.full_url.startswith(url_prefix):
+            workers.append(worker)
+
+    def read_bytes():
+        total = 0
+        for worker in list(workers):
+            if worker not in finals:
+                n = _transfer_bytes(worker)
+                # started (it has an ident) and done
+                if worker.ident is not None and not worker.is_alive():
+                    finals[worker] = n
+                total += n
+            else:
+                total += finals[worker]
+        return total
+
+    with _counting_lock:
+        if not _counting_users[0]:
+            for cls in ("HTTPDownloader", "HTTPUploader"):
+                _counting_users[1][cls] = getattr(speedtest, cls)
+                setattr(speedtest, cls, _counting_worker(_counting_users[1][cls]))
+        _counting_users[0] += 1
+        _byte_counters.append(add)
+    try:
+        yield read_bytes
+    finally:
+        with _counting_lock:
+            _byte_counters.remove(add)
+            _counting_users[0] -= 1
+            if not _counting_users[0]:
+                for cls, original in _counting_users[1].items():
+                    setattr(speedtest, cls, original)
+
+def _t95(df):
+    # two-sided 95% Student t quantile, by the Cornish-Fisher expansion
+    # around the normal one; within 2% of the exact value from df=4 on
+    z = 1.959964
+    return z + (z ** 3 + z) / (4 * df) + (5 * z ** 5 + 16 * z ** 3 + 3 * z) / (96 * df ** 2)
+
+def steady_throughput(samples, warmup=CONVERGE_WARMUP_S, window=CONVERGE_WINDOW_S):
+    """
+    Mean throughput in bits/s over the window second stretches of
+    ThroughputSampler samples past warmup seconds, the half-width of its 95%
+    confidence interval and the number of windows. The mean is None before
+    the first full window, the half-width until there are two.
+    """
+    rates = []
+    start = None
+    for t, total, _ in samples:
+        if t < warmup:
+            continue
+        if start is None:
+            start = (t, total)
+        elif t - start[0] >= window:
+            rates.append((total - start[1]) * 8 / (t - start[0]))
+            start = (t, total)
+    if not rates:
+        return None, None, 0
+    mean = sum(rates) / len(rates)
+    if len(rates) < 2:
+        return mean, None, 1
+    sd = math.sqrt(sum((r - mean) ** 2 for r in rates) / (len(rates) - 1))
+    return mean, _t95(len(rates) - 1) * sd / math.sqrt(len(rates)), len(rates)
+
+class ThroughputSampler:
+    """
+    Calls read_bytes every interval seconds while active and records the
+    samples as [seconds, bytes, mbps] triples in self.samples.
+
+        with _worker_byte_counter("download") as read_bytes, ThroughputSampler(read_bytes) as sampler:
+            s.download()
+
+    Given a stop function, it calls it once, from the sampling thread, when
+    the steady_throughput() confidence interval has narrowed to converge
+    times the mean or max_bytes have been moved, and records why in
+    self.stopped ("converged" or "bytes").
+    """
+
+    def __init__(self, read_bytes, interval=0.1, stop=None, converge=None, max_bytes=None):
+        self.read_bytes = read_bytes
+        self.interval = interval
+        self.samples = []
+        self.stop = stop
+        self.converge = converge
+        self.max_bytes = max_bytes
+        self.stopped = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        self._last = (0.0, 0)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.sample()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def sample(self):
+        total = self.read_bytes()
+        now = time.perf_counter() - self._start
+        last_t, last_bytes = self._last
+        mbps = (total - last_bytes) * 8 / (now - last_t) / 1_000_000 if now > last_t else 0.0
+        self._last = (now, total)
+        self.samples.append([round(now, 3), total, round(mbps, 3)])
+        if self.stop is None or self.stopped:
+            return
+        if self.max_bytes and total >= self.max_bytes:
+            self.stopped = "bytes"
+        elif self.converge:
+            mean, half_width, windows = steady_throughput(self.samples)
+            if windows >= CONVERGE_MIN_WINDOWS and mean > 0 and half_width <= self.converge * mean:
+                self.stopped = "converged"
+        if self.stopped:
+            self.stop()
+
+@contextlib.contextmanager
+def _sampling(progress, name, read_bytes, interval, stop=None, tuning=None):
+    """
+    Sample throughput while the block runs if progress is a dict, stored
+    there under name, or if tuning asks for a converge or max_bytes early
+    stop through stop. Yields the ThroughputSampler, or None when neither applies.
+    """
+    tuning = tuning or {}
+    if stop is None or not (tuning.get("converge") or tuning.get("max_bytes")):
+        stop = None
+        if progress is None:
+            yield None
+            return
+    with ThroughputSampler(read_bytes, interval, stop, tuning.get("converge"), tuning.get("max_bytes")) as sampler:
+        yield sampler
+    if progress is not None:
+        progress[name] = sampler.samples
+
+def tuned_config(config, tuning):
+    """
+    Return a copy of a speedtest config with the transfer settings in the
+    tuning dict applied: download_sizes, upload_sizes, count (requests per
+    size), duration (seconds per direction) and download_threads and
+    upload_threads. Missing or None entries keep the config's values.
+    """
+    config = {**config, **{k: dict(config[k]) for k in ("sizes", "counts", "threads", "length")}}
+    for direction in ("download", "upload"):
+        if tuning.get(f"{direction}_sizes"):
+            config["sizes"][direction] = list(tuning[f"{direction}_sizes"])
+        if tuning.get("count"):
+            config["counts"][direction] = tuning["count"]
+        if tuning.get("duration"):
+            config["length"][direction] = tuning["duration"]
+        if tuning.get(f"{direction}_threads"):
+            config["threads"][direction] = tuning[f"{direction}_threads"]
+    config["upload_max"] = len(config["sizes"]["upload"]) * config["counts"]["upload"]
+    return config
+
+def _pre_allocate(config, policy):
+    """Whether speedtest should build the upload payloads before the upload starts ("shared" builds none)."""
+    if policy == "auto":
+        return sum(config["sizes"]["upload"]) * config["counts"]["upload"] <= PRE_ALLOCATE_BUDGET
+    return policy == "always"
+
+def _autotune_next(trials, limit):
+    """
+    Given the (threads, bits/s) autotune trials run so far, return the next
+    thread count to try, or None once throughput has stopped growing by
+    AUTOTUNE_GAIN per doubling or limit is reached.
+    """
+    if not trials:
+        return 1
+    threads, _ = _autotune_best(trials)
+    if threads != trials[-1][0] or threads * 2 > limit:
+        return None
+    return threads * 2
+
+def _autotune_best(trials):
+    """The (threads, bits/s) trial with the fewest threads past which throughput plateaued."""
+    best = trials[0]
+    for trial in trials[1:]:
+        if trial[1] < best[1] * AUTOTUNE_GAIN:
+            break
+        best = trial
+    return best
+
+def _autotune(s, direction, limit, pre_allocate=False):
+    # short trials with the speedtest client itself; the real run follows
+    length = s.config["length"][direction]
+    s.config["length"][direction] = min(length, AUTOTUNE_TRIAL_S)
+    trials = []
+    try:
+        while (threads := _autotune_next(trials, limit)) is not None:
+            if direction == "download":
+                bps = s.download(threads=threads)
+            else:
+                bps = s.upload(pre_allocate=pre_allocate, threads=threads)
+            trials.append((threads, bps))
+    finally:
+        s.config["length"][direction] = length
+    return _autotune_best(trials)[0]
+
+class _ShutdownEvent(threading.Event):
+    """threading.Event that also answers speedtest's deprecated isSet() without a warning."""
+
+    def isSet(self):
+        return self.is_set()
+
+def _is_set(event):
+    # speedtest's FakeShutdownEvent only has isSet()
+    return event is not None and (event.is_set() if hasattr(event, "is_set") else event.isSet())
+
+def new_client(source_address=None, timings=None):
+    """
+    Create a speedtest.Speedtest; this downloads the speedtest.net config.
+    It gets a shutdown event so run_speedtest() can cut a transfer short.
+    """
+    import speedtest
+
+    with _phase(timings, "config"):
+        return speedtest.Speedtest(source_address=source_address, shutdown_event=_ShutdownEvent())
+
+@contextlib.contextmanager
+def _stoppable(s, direction, tuning):
+    """
+    If tuning asks for a converge or max_bytes early stop, yield a function
+    that ends the download or upload s is running: workers not started yet
+    skip their request, as their test length is cut to 0, and running ones
+    stop at their next read through the client's shutdown event. Both are
+    reset afterwards. Yields None otherwise.
+    """
+    if not (tuning.get("converge") or tuning.get("max_bytes")):
+        yield None
+        return
+    length = s.config["length"][direction]
+    # speedtest keeps the event it was created with privately; new_client()
+    # passes one, a client created without one has a FakeShutdownEvent that
+    # can't be set, so only the workers not started yet stop early
+    event = getattr(s, "_shutdown_event", None)
+    if not hasattr(event, "set") or not hasattr(event, "clear"):
+        event = None
+
+    def stop():
+        s.config["length"][direction] = 0
+        if event is not None:
+            event.set()
+
+    try:
+        yield stop
+    finally:
+        s.config["length"][direction] = length
+        if event is not None:
+            event.clear()
+
+def _early_stop(timings, direction, sampler, bps, tuning):
+    """
+    With --converge, the steady-state throughput of a sampled phase, else
+    bps; records why the phase ended as <direction>_stop in timings.
+    """
+    if sampler is None or sampler.stop is None:
+        return bps
+    if timings is not None:
+        timings[f"{direction}_stop"] = sampler.stopped or "full"
+    if tuning.get("converge"):
+        mean, _, _ = steady_throughput(sampler.samples)
+        if mean is not None:
+            return mean
+    return bps
+
+def run_speedtest(s=None, server_cache=None, server_cache_ttl=SERVER_CACHE_TTL, source_address=None, timings=None,
+                  progress=None, progress_interval=0.1, server=None, tuning=None):
+    """
+    Run one measurement. Pass a long-lived speedtest.Speedtest as s to reuse
+    its config and server list; by default a fresh client is created, bound
+    to source_address if given. server_cache is the path of an on-disk
+    server cache (see select_server). If timings is a dict, the TIMING_FIELDS
+    profile of the run is stored in it. If progress is a dict, throughput is
+    sampled every progress_interval seconds and the ThroughputSampler series
+    are stored in it under "download" and "upload". Passing a server dict
+    (from the server list) tests that server instead of the best one.
+    tuning overrides the transfer settings (see tuned_config) and may set
+    pre_allocate ("never", "always", "auto" or "shared" for
+    SharedUploadData payloads), and autotune with
+    max_threads to pick each direction's thread count by short trials
+    first; those are part of the download and upload phases. converge
+    and max_bytes end each direction early (see ThroughputSampler); with
+    converge its steady-state throughput is reported instead of
+    speedtest's average over the whole transfer.
+    """
+    tuning = tuning or {}
+    if s is None:
+        s = new_client(source_address, timings)
+    with _phase(timings, "server"):
+        if server is not None:
+            s.get_best_server([dict(server)])  # pings it and makes it the test server
+        else:
+            select_server(s, server_cache, server_cache_ttl, key=source_address or "")
+    base_url = os.path.dirname(s.best["url"])
+    s.config = tuned_config(s.config, tuning)
+    payload = tuning.get("pre_allocate", "never")
+    pre_allocate = _pre_allocate(s.config, payload)
+    with _phase(timings, "download"):
+        threads = s.config["threads"]["download"]
+        if tuning.get("autotune"):
+            threads = _autotune(s, "download", tuning.get("max_threads", 64))
+        with _stoppable(s, "download", tuning) as stop, _worker_byte_counter("download", base_url) as read_bytes, \
+                _sampling(progress, "download", read_bytes, progress_interval, stop, tuning) as sampler:
+            download_bps = s.download(threads=threads)
+        download_bps = _early_stop(timings, "download", sampler, download_bps, tuning)
+    if timings is not None:
+        timings["download_threads"] = threads
+    with _phase(timings, "upload"), (_shared_upload_payload() if payload == "shared" else contextlib.nullcontext()):
+        # download() raises the upload thread count on fast links
+        threads = tuning.get("upload_threads") or s.config["threads"]["upload"]
+        if tuning.get("autotune"):
+            threads = _autotune(s, "upload", tuning.get("max_threads", 64), pre_allocate)
+        with _stoppable(s, "upload", tuning) as stop, _worker_byte_counter("upload", base_url) as read_bytes, \
+                _sampling(progress, "upload", read_bytes, progress_interval, stop, tuning) as sampler:
+            upload_bps = s.upload(pre_allocate=pre_allocate, threads=threads)
+        upload_bps = _early_stop(timings, "upload", sampler, upload_bps, tuning)
+    if timings is not None:
+        timings["upload_threads"] = threads
+        timings["bytes_received"] = s.results.bytes_received
+        timings["bytes_sent"] = s.results.bytes_sent
+    return _result_row(s.results.dict(), download_bps, upload_bps)
+
+def _result_row(results, download_bps, upload_bps):
+    return {
+        # use timezone-aware UTC to avoid DeprecationWarning
+        "timestamp": datetime.now(timezone.utc).isoformat().replace("+00:00", "Z"),
+        "server_id": results.get("server", {}).get("id"),
+        "server_name": results.get("server", {}).get("name"),
+        "sponsor": results.get("server", {}).get("sponsor"),
+        "country": results.get("server", {}).get("country"),
+        "host": results.get("server", {}).get("host"),
+        "lat": results.get("server", {}).get("lat"),
+        "lon": results.get("server", {}).get("lon"),
+        "ping_ms": results.get("ping"),
+        "download_mbps": round(download_bps / 1_000_000, 3),
+        "upload_mbps": round(upload_bps / 1_000_000, 3),
+        "client_ip": results.get("client", {}).get("ip"),
+        "client_isp": results.get("client", {}).get("isp"),
+    }
+
+# body of speedtest uploads after the "content1=" prefix; one shared copy of
+# the pattern, a multiple of its length, is sliced for every request
+UPLOAD_CHARS = b"0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+_UPLOAD_BUFFER = UPLOAD_CHARS * 1820  # ~64 KiB
+_UPLOAD_HEAD = b"content1="
+
+def _upload_chunks(size):
+    """Yield memoryview slices of the shared buffer that make up a size-byte upload body."""
+    head = memoryview(_UPLOAD_HEAD)[:size]
+    yield head
+    view = memoryview(_UPLOAD_BUFFER)
+    remaining = size - len(head)
+    while remaining > 0:
+        n = min(remaining, len(view))
+        yield view[:n]
+        remaining -= n
+
+class _AsyncHTTPConnection:
+    """Minimal keep-alive HTTP/1.1 client on asyncio streams, for the asyncio engine."""
+
+    def __init__(self, url, source_address=None, user_agent="", timeout=10):
+        parts = urlsplit(url)
+        self.netloc = parts.netloc
+        self.host = parts.hostname
+        self.port = parts.port or (443 if parts.scheme == "https" else 80)
+        self.ssl = parts.scheme == "https" or None
+        self.source_address = source_address
+        self.user_agent = user_agent
+        self.timeout = timeout
+        self.reader = self.writer = None
+
+    async def connect(self):
+        import asyncio
+
+        if self.writer is None:
+            local_addr = (self.source_address, 0) if self.source_address else None
+            self.reader, self.writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port, ssl=self.ssl, local_addr=local_addr), self.timeout)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.reader = self.writer = None
+
+    async def request(self, method, path, body=None, body_size=0, on_bytes=None, deadline=None):
+        """
+        Send one request and read the response, reporting body bytes sent and
+        received to on_bytes. Returns (status, start of the response body),
+        or (None, b"") once deadline (in loop.time()) has passed, in which
+        case the connection is closed mid-transfer.
+        """
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+
+        def wait():
+            if deadline is None:
+                return self.timeout
+            return max(0.0, min(self.timeout, deadline - loop.time()))
+
+        def expired():
+            return deadline is not None and loop.time() >= deadline
+
+        await self.connect()
+        head = [f"{method} {path} HTTP/1.1", f"Host: {self.netloc}", f"User-Agent: {self.user_agent}",
+                "Cache-Control: no-cache"]
+        if body is not None:
+            head += [f"Content-Length: {body_size}", "Content-Type: application/x-www-form-urlencoded"]
+        self.writer.write(("\r\n".join(head) + "\r\n\r\n").encode())
+        try:
+            for chunk in body or ():
+                if expired():
+                    self.close()
+                    return None, b""
+                self.writer.write(chunk)
+                await asyncio.wait_for(self.writer.drain(), wait())
+                if on_bytes:
+                    on_bytes(len(chunk))
+
+            status_line = await asyncio.wait_for(self.reader.readline(), wait())
+            if not status_line:
+                raise ConnectionError("connection closed by server")
+            status = int(status_line.split()[1])
+            headers = {}
+            while True:
+                line = await asyncio.wait_for(self.reader.readline(), wait())
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers[name.strip().lower()] = value.strip()
+
+            # speedtest servers send Content-Length; without one, read to EOF
+            remaining = int(headers["content-length"]) if "content-length" in headers else None
+            first = b""
+            while remaining is None or remaining > 0:
+                if expired():
+                    self.close()
+                    return None, first
+                data = await asyncio.wait_for(self.reader.read(65536 if remaining is None else min(remaining, 65536)), wait())
+                if not data:
+                    if remaining is None:
+                        break
+                    raise ConnectionError("connection closed by server")
+                if len(first) < 64:
+                    first += data[:64 - len(first)]
+                if remaining is not None:
+                    remaining -= len(data)
+                if on_bytes:
+                    on_bytes(len(data))
+        except asyncio.TimeoutError:
+            if not expired():
+                raise
+            self.close()
+            return None, b""
+        if remaining is None or headers.get("connection", "").lower() == "close":
+            self.close()
+        return status, first
+
+class SharedUploadData:
+    """
+    Drop-in for speedtest.HTTPUploaderData that serves the upload body as
+    memoryview slices of the shared _UPLOAD_BUFFER, the same bytes speedtest
+    would build. Memory use stays at that one buffer whatever the payload
+    sizes and thread count, and no CPU goes into generating payloads.
+    """
+
+    def __init__(self, length, start, timeout, shutdown_event=None):
+        self.length = length
+        self.start = start
+        self.timeout = timeout
+        self._shutdown_event = shutdown_event
+        self._view = memoryview(_UPLOAD_BUFFER)
+        self._pos = 0
+        self.total = [0]
+
+    def pre_allocate(self):
+        pass  # nothing to build
+
+    def read(self, n=10240):
+        import speedtest
+
+        if time.perf_counter() - self.start > self.timeout or _is_set(self._shutdown_event):
+            raise speedtest.SpeedtestUploadTimeout()
+        n = min(n, self.length - self._pos)
+        if self._pos < len(_UPLOAD_HEAD):
+            chunk = memoryview(_UPLOAD_HEAD)[self._pos:self._pos + n]
+        else:
+            offset = (self._pos - len(_UPLOAD_HEAD)) % len(UPLOAD_CHARS)
+            chunk = self._view[offset:offset + n]
+        self._pos += len(chunk)
+        self.total.append(len(chunk))
+        return chunk
+
+    def __len__(self):
+        return self.length
+
+_shared_payload_lock = threading.Lock()
+_shared_payload_users = [0]
+
+@contextlib.contextmanager
+def _shared_upload_payload():
+    """Make speedtest's upload() use SharedUploadData; safe for uploads running in several threads."""
+    import speedtest
+
+    with _shared_payload_lock:
+        if not _shared_payload_users[0]:
+            _shared_payload_users.append(speedtest.HTTPUploaderData)
+            speedtest.HTTPUploaderData = SharedUploadData
+        _shared_payload_users[0] += 1
+    try:
+        yield
+    finally:
+        with _shared_payload_lock:
+            _shared_payload_users[0] -= 1
+            if not _shared_payload_users[0]:
+                speedtest.HTTPUploaderData = _shared_payload_users.pop()
+
+async def _probe_latency(server, source_address=None, user_agent="", probes=3):
+    """
+    Mean round trip in ms of probes latency.txt requests on one warm
+    connection, or None if the server is unreachable. speedtest times each
+    probe with a fresh connection and halves the total, which comes to about
+    the same figure.
+    """
+    import asyncio
+
+    base_url = server["url"].rsplit("/", 1)[0]
+    path = urlsplit(base_url).path
+    conn = _AsyncHTTPConnection(base_url, source_address, user_agent)
+    rtts = []
+    try:
+        await conn.connect()
+        for i in range(probes):
+            t0 = time.perf_counter()
+            status, body = await conn.request("GET", f"{path}/latency.txt?x={int(time.time() * 1000)}.{i}")
+            ok = status == 200 and body.startswith(b"test=test")
+            rtts.append(time.perf_counter() - t0 if ok else 3600)
+    except (OSError, ValueError, IndexError, asyncio.TimeoutError):
+        return None
+    finally:
+        conn.close()
+    return round(sum(rtts) / len(rtts) * 1000, 3)
+
+async def probe_latency_series(server, samples, rate, source_address=None, user_agent="", timeout=LATENCY_TIMEOUT):
+    """
+    Send samples latency.txt requests to server, rate per second on a fixed
+    schedule, and return their round trips in ms, None for each lost one.
+    Probes go out on warm keep-alive connections, a new one opened only
+    while all others are busy, and connecting is not timed, so a round trip
+    is one small request and response.
+    """
+    import asyncio
+
+    base_url = server["url"].rsplit("/", 1)[0]
+    path = urlsplit(base_url).path
+    stamp = int(time.time() * 1000)
+    rtts = [None] * samples
+    idle = []
+
+    async def probe(i):
+        conn = idle.pop() if idle else _AsyncHTTPConnection(base_url, source_address, user_agent, timeout)
+        try:
+            await conn.connect()
+            t0 = time.perf_counter()
+            status, body = await conn.request("GET", f"{path}/latency.txt?x={stamp}.{i}")
+            if status == 200 and body.startswith(b"test=test"):
+                rtts[i] = (time.perf_counter() - t0) * 1000
+        except (OSError, ValueError, IndexError, asyncio.TimeoutError):
+            conn.close()  # reconnects on its next probe
+        idle.append(conn)
+
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    tasks = []
+    try:
+        for i in range(samples):
+            delay = start + i / rate - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(probe(i)))
+        await asyncio.gather(*tasks)
+    finally:
+        for conn in idle:
+            conn.close()
+    return rtts
+
+def _percentile(ordered, p):
+    # linear interpolation between closest ranks, as numpy.percentile does
+    k = (len(ordered) - 1) * p / 100
+    lo = math.floor(k)
+    hi = min(lo + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+def latency_stats(rtts):
+    """LATENCY_FIELDS of a probe_latency_series() result; the ms figures are None when every probe was lost."""
+    ok = [rtt for rtt in rtts if rtt is not None]
+    stats = dict.fromkeys(LATENCY_FIELDS)
+    stats.update(latency_samples=len(rtts), latency_lost=len(rtts) - len(ok),
+                 latency_loss_pct=round((len(rtts) - len(ok)) * 100 / len(rtts), 3) if rtts else None)
+    if ok:
+        ordered = sorted(ok)
+        jitter = sum(abs(b - a) for a, b in zip(ok, ok[1:])) / (len(ok) - 1) if len(ok) > 1 else 0.0
+        stats.update(latency_min_ms=ordered[0], latency_avg_ms=sum(ok) / len(ok), latency_max_ms=ordered[-1],
+                     latency_jitter_ms=jitter, latency_p50_ms=_percentile(ordered, 50),
+                     latency_p95_ms=_percentile(ordered, 95), latency_p99_ms=_percentile(ordered, 99))
+        for fn in LATENCY_FIELDS[3:]:
+            stats[fn] = round(stats[fn], 3)
+    return stats
+
+async def _select_server_async(s, cache_path=None, ttl=SERVER_CACHE_TTL, source_address=None, user_agent=""):
+    """
+    select_server() for the asyncio engine: probes every candidate at once,
+    the cached closest servers while the cache is fresh, which costs about
+    one probe, and records the pick in the same cache.
+    """
+    import asyncio
+    import speedtest
+
+    key = source_address or ""
+    entry = _load_server_cache(cache_path, key) if cache_path and ttl > 0 else None
+    fresh = bool(entry and entry.get("closest") and time.time() - entry.get("saved_at", 0) < ttl)
+    if fresh:
+        candidates = [dict(c) for c in entry["closest"]]
+        latencies = await asyncio.gather(*(_probe_latency(c, source_address, user_agent) for c in candidates))
+        scored = [(lat, c) for lat, c in zip(latencies, candidates) if lat is not None and lat < UNREACHABLE_MS]
+        fresh = bool(scored)  # every cached server is gone: rediscover
+    if not fresh:
+        candidates = s.closest or await asyncio.to_thread(s.get_closest_servers)
+        latencies = await asyncio.gather(*(_probe_latency(c, source_address, user_agent) for c in candidates))
+        scored = [(lat, c) for lat, c in zip(latencies, candidates) if lat is not None and lat < UNREACHABLE_MS]
+    if not scored:
+        raise speedtest.SpeedtestBestServerFailure("Unable to connect to servers to test latency.")
+    latency, best = min(scored, key=lambda lc: lc[0])
+    best = {**best, "latency": latency}
+    if cache_path and ttl > 0:
+        _save_server_cache(cache_path, key, {"saved_at": entry["saved_at"] if fresh else time.time(),
+                                             "closest": candidates, "best": best})
+    return best
+
+def rank_servers(s, count):
+    """
+    Return the count lowest-latency servers among the closest ones, each
+    with its "latency", pinging the candidates one by one like speedtest.
+    """
+    limit = max(5, 2 * count)
+    if len(s.closest) < limit:
+        # get_closest_servers() appends to what is already there
+        del s.closest[:]
+        s.get_closest_servers(limit)
+    ranked = [dict(s.get_best_server([dict(c)])) for c in s.closest]
+    ranked.sort(key=lambda srv: srv["latency"])
+    return ranked[:count]
+
+async def _rank_servers_async(s, count, source_address=None, user_agent=""):
+    """rank_servers() for the asyncio engine; probes every candidate at once."""
+    import asyncio
+
+    limit = max(5, 2 * count)
+    if len(s.closest) < limit:
+        del s.closest[:]
+        await asyncio.to_thread(s.get_closest_servers, limit)
+    candidates = [dict(c) for c in s.closest]
+    latencies = await asyncio.gather(*(_probe_latency(c, source_address, user_agent) for c in candidates))
+    ranked = [{**c, "latency": lat} for lat, c in zip(latencies, candidates) if lat is not None]
+    ranked.sort(key=lambda srv: srv["latency"])
+    return ranked[:count]
+
+async def _transfer_async(base_url, jobs, connections, length, on_bytes, source_address=None, user_agent="",
+                          stop=None):
+    """
+    Work through jobs, (method, path, body_size or None) tuples, on
+    `connections` keep-alive connections until all are done, length
+    seconds have passed or the asyncio.Event stop is set; returns the
+    elapsed seconds.
+    """
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+    deadline = start + length
+    jobs = iter(jobs)  # shared by the workers; safe, they run on one thread
+
+    async def worker():
+        conn = _AsyncHTTPConnection(base_url, source_address, user_agent)
+        try:
+            for method, path, size in jobs:
+                body = _upload_chunks(size) if size else None
+                status, _ = await conn.request(method, path, body, size or 0, on_bytes, deadline)
+                if status is None:
+                    break
+        except (OSError, ValueError, IndexError, asyncio.TimeoutError):
+            pass  # like speedtest, a failed transfer just stops adding bytes
+        finally:
+            conn.close()
+
+    workers = asyncio.gather(*(worker() for _ in range(connections)))
+    if stop is None:
+        await workers
+        return loop.time() - start
+    stopped = asyncio.ensure_future(stop.wait())
+    await asyncio.wait([workers, stopped], return_when=asyncio.FIRST_COMPLETED)
+    elapsed = loop.time() - start
+    # cancelled workers close their connections mid-transfer
+    stopped.cancel()
+    workers.cancel()
+    with contextlib.suppress(asyncio.CancelledError):
+        await workers
+    return elapsed
+
+async def run_speedtest_async(s=None, server_cache=None, server_cache_ttl=SERVER_CACHE_TTL, source_address=None,
+                              timings=None, progress=None, progress_interval=0.1, server=None, tuning=None):
+    """
+    Asyncio engine behind run_speedtest(): same arguments and row, but the
+    latency probes, download and upload run as coroutines over asyncio
+    streams instead of an OS thread per connection, so many devices or
+    servers can share one event loop. The speedtest client is still used
+    for the config and server list, fetched in a worker thread. Upload
+    bodies are always slices of one shared buffer, so pre_allocate is ignored.
+    """
+    import asyncio
+    import speedtest
+
+    tuning = tuning or {}
+    if s is None:
+        s = await asyncio.to_thread(new_client, source_address, timings)
+    user_agent = speedtest.build_user_agent()
+    with _phase(timings, "server"):
+        if server is not None:
+            latency = await _probe_latency(server, source_address, user_agent)
+            if latency is None:
+                raise speedtest.SpeedtestBestServerFailure(f"Unable to reach server {server.get('id')}.")
+            best = {**server, "latency": latency}
+        else:
+            best = await _select_server_async(s, server_cache, server_cache_ttl, source_address, user_agent)
+    base_url = best["url"].rsplit("/", 1)[0]
+    base_path = urlsplit(base_url).path
+    # a copy: coroutines testing several servers share s
+    config = tuned_config(s.config, tuning)
+    stamp = int(time.time() * 1000)
+
+    async def autotune(jobs, direction):
+        trials = []
+        while (n := _autotune_next(trials, tuning.get("max_threads", 64))) is not None:
+            moved = [0]
+            elapsed = await _transfer_async(base_url, jobs, n, min(config["length"][direction], AUTOTUNE_TRIAL_S),
+                                            lambda k: moved.__setitem__(0, moved[0] + k), source_address, user_agent)
+            trials.append((n, moved[0] * 8 / elapsed if elapsed > 0 else 0.0))
+        return _autotune_best(trials)[0]
+
+    received = [0]
+    downloads = [("GET", f"{base_path}/random{size}x{size}.jpg?x={stamp}.{i}", None)
+                 for i, size in enumerate(size for size in config["sizes"]["download"]
+                                          for _ in range(config["counts"]["download"]))]
+    loop = asyncio.get_running_loop()
+    with _phase(timings, "download"):
+        threads = config["threads"]["download"]
+        if tuning.get("autotune"):
+            threads = await autotune(downloads, "download")
+        stop = asyncio.Event()
+        with _sampling(progress, "download", lambda: received[0], progress_interval,
+                       lambda: loop.call_soon_threadsafe(stop.set), tuning) as sampler:
+            elapsed = await _transfer_async(base_url, downloads, threads, config["length"]["download"],
+                                            lambda n: received.__setitem__(0, received[0] + n), source_address, user_agent,
+                                            stop)
+        download_bps = _early_stop(timings, "download", sampler, received[0] * 8 / elapsed if elapsed > 0 else 0.0,
+                                   tuning)
+    if timings is not None:
+        timings["download_threads"] = threads
+
+    sent = [0]
+    sizes = [size for size in config["sizes"]["upload"] for _ in range(config["counts"]["upload"])]
+    uploads = [("POST", f"{urlsplit(best['url']).path}?x={stamp}.{i}", size)
+               for i, size in enumerate(sizes[:config["upload_max"]])]
+    with _phase(timings, "upload"):
+        # speedtest.download() switches to 8 upload threads on all but the slowest links
+        threads = tuning.get("upload_threads") or (8 if download_bps > 100000 else config["threads"]["upload"])
+        if tuning.get("autotune"):
+            threads = await autotune(uploads, "upload")
+        stop = asyncio.Event()
+        with _sampling(progress, "upload", lambda: sent[0], progress_interval,
+                       lambda: loop.call_soon_threadsafe(stop.set), tuning) as sampler:
+            elapsed = await _transfer_async(base_url, uploads, threads, config["length"]["upload"],
+                                            lambda n: sent.__setitem__(0, sent[0] + n), source_address, user_agent,
+                                            stop)
+        upload_bps = _early_stop(timings, "upload", sampler, sent[0] * 8 / elapsed if elapsed > 0 else 0.0, tuning)
+    if timings is not None:
+        timings["upload_threads"] = threads
+        timings["bytes_received"] = received[0]
+        timings["bytes_sent"] = sent[0]
+
+    # no awaits from here on: coroutines testing several servers share s
+    results = s.results
+    results.ping = best["latency"]
+    results.server = best
+    results.download, results.upload = download_bps, upload_bps
+    results.bytes_received, results.bytes_sent = received[0], sent[0]
+    return _result_row(results.dict(), download_bps, upload_bps)
+
+async def run_latency_async(s=None, server_cache=None, server_cache_ttl=SERVER_CACHE_TTL, source_address=None,
+                            timings=None, samples=100, rate=10.0, server=None):
+    """
+    --latency-only: pick a server like run_speedtest_async(), then take
+    samples round trips to it at rate per second with probe_latency_series()
+    instead of measuring throughput. The row has the usual server columns,
+    the mean round trip as ping_ms, blank download and upload, and the
+    LATENCY_FIELDS; it is returned even if every probe was lost.
+    """
+    import asyncio
+    import speedtest
+
+    if s is None:
+        s = await asyncio.to_thread(new_client, source_address, timings)
+    user_agent = speedtest.build_user_agent()
+    with _phase(timings, "server"):
+        best = server or await _select_server_async(s, server_cache, server_cache_ttl, source_address, user_agent)
+    stats = latency_stats(await probe_latency_series(best, samples, rate, source_address, user_agent))
+
+    results = s.results
+    results.ping = stats["latency_avg_ms"]
+    results.server = best
+    row = _result_row(results.dict(), 0, 0)
+    # None, not "": typed stores keep these columns numeric
+    row.update(download_mbps=None, upload_mbps=None, **stats)
+    return row
+
+# (st_dev, st_ino, header) of CSV files whose header was already checked,
+# keyed by path; a rewrite through os.replace changes the inode and
+# invalidates the entry.
+_header_cache = {}
+
+def _read_csv_header(path):
+    """Return the header of the CSV at path, reading only its first line."""
+    with open(path, newline="", encoding="utf-8") as f:
+        first = f.readline()
+    return next(csv.reader([first]), []) if first else []
+
+# (index file size, (device, day) keys) of sidecar indexes, keyed by CSV path
+_index_cache = {}
+# how much of the end of an index a writer reads to find the recent days
+_INDEX_TAIL_BYTES = 4096
+
+def _read_csv_index(path):
+    """Return {(device, day): offset of its first row} from the sidecar index of the CSV at path."""
+    index = {}
+    try:
+        with open(path + ".idx", newline="", encoding="utf-8") as f:
+            for entry in csv.reader(f):
+                if len(entry) == 3 and entry[2].isdigit():
+                    key = (entry[0], entry[1])
+                    index[key] = min(index.get(key, int(entry[2])), int(entry[2]))
+    except FileNotFoundError:
+        pass
+    return index
+
+def _rebuild_csv_index(path):
+    """Write the sidecar index of the CSV at path from scratch."""
+    entries = {}
+    with open(path, "rb") as f:
+        header = next(csv.reader([f.readline().decode("utf-8")]), [])
+        if "timestamp" in header:
+            device_col = header.index("device") if "device" in header else None
+            ts_col = header.index("timestamp")
+            offset = f.tell()
+            for line in f:
+                fields = next(csv.reader([line.decode("utf-8", "replace")]), [])
+                if len(fields) > ts_col:
+                    device = fields[device_col] if device_col is not None and len(fields) > device_col else ""
+                    entries.setdefault((device, fields[ts_col][:10]), offset)
+                offset += len(line)
+    tmp_path = path + ".idx.tmp"
+    with open(tmp_path, "w", newline="", encoding="utf-8") as f:
+        csv.writer(f).writerows([device, day, offset] for (device, day), offset in entries.items())
+    os.replace(tmp_path, path + ".idx")
+    _index_cache[path] = (os.path.getsize(path + ".idx"), set(entries))
+
+def _update_csv_index(path, entries, created):
+    """
+    Add the (device, day, offset) entries of rows just appended to the CSV
+    at path to its sidecar index; only the first row of each (device, day)
+    is recorded. created says the CSV was new, so any old index is stale.
+    """
+    idx_path = path + ".idx"
+    try:
+        size = 0 if created else os.path.getsize(idx_path)
+    except FileNotFoundError:
+        _rebuild_csv_index(path)  # an older log: index all of it once
+        return
+    cached = _index_cache.get(path)
+    if created:
+        keys = set()
+    elif cached and cached[0] == size:
+        keys = cached[1]
+    else:
+        # appends are time-ordered, so only recent days can already be
+        # indexed; a duplicate entry is harmless anyway
+        with open(idx_path, "rb") as f:
+            f.seek(max(0, size - _INDEX_TAIL_BYTES))
+            tail = f.read().decode("utf-8", "replace").splitlines()[1 if size > _INDEX_TAIL_BYTES else 0:]
+        keys = {(entry[0], entry[1]) for entry in csv.reader(tail) if len(entry) == 3}
+    new = []
+    for device, day, offset in entries:
+        if (device, day) not in keys:
+            keys.add((device, day))
+            new.append([device, day, offset])
+    if new or created:
+        with open(idx_path, "w" if created else "a", newline="", encoding="utf-8") as f:
+            csv.writer(f).writerows(new)
+    _index_cache[path] = (os.path.getsize(idx_path) if new or created else size, keys)
+
+def _ensure_csv_has_header(path, fieldnames, device_default=""):
+    """
+    If CSV exists but is missing required columns (like 'device'),
+    rewrite the file adding the missing columns (existing rows get empty/default values).
+
+    Returns the header rows must be appended with, or None when the file is
+    missing or empty and the header still has to be written.
+    """
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None  # will be created by write_csv and header written there
+    if st.st_size == 0:
+        return None
+
+    cached = _header_cache.get(path)
+    if cached and cached[:2] == (st.st_dev, st.st_ino):
+        existing_fields = cached[2]
+    else:
+        existing_fields = _read_csv_header(path)
+    # if all required fields already present, nothing to do
+    if all(fn in existing_fields for fn in fieldnames):
+        _header_cache[path] = (st.st_dev, st.st_ino, existing_fields)
+        return existing_fields
+
+    # keep columns the caller doesn't know about after the required ones
+    new_fields = list(fieldnames) + [fn for fn in existing_fields if fn not in fieldnames]
+    tmp_path = path + ".tmp"
+    with open(path, newline="", encoding="utf-8") as src, \
+            open(tmp_path, "w", newline="", encoding="utf-8") as f:
+        reader = csv.DictReader(src)
+        writer = csv.DictWriter(f, fieldnames=new_fields)
+        writer.writeheader()
+        # stream rows across instead of loading the whole file
+        for r in reader:
+            # populate new row: use existing values where present, default otherwise
+            new_row = {}
+            for fn in new_fields:
+                if fn in r:
+                    new_row[fn] = r.get(fn, "")
+                else:
+                    # set device default (usually empty) for old rows
+                    new_row[fn] = device_default if fn == "device" else ""
+            writer.writerow(new_row)
+    os.replace(tmp_path, path)
+    st = os.stat(path)
+    _header_cache[path] = (st.st_dev, st.st_ino, new_fields)
+    _rebuild_csv_index(path)  # every row moved
+    return new_fields
+
+@contextlib.contextmanager
+def lock_file(path):
+    """
+    Hold an exclusive advisory lock for path, on the separate file
+    path + ".lock" so that path itself can be replaced while locked. Waits
+    for other holders, in this or other processes: flock() on POSIX,
+    msvcrt.locking() on Windows.
+    """
+    with open(path + ".lock", "a+b") as f:
+        if os.name == "nt":
+            import msvcrt
+
+            while True:
+                f.seek(0)
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    pass  # LK_LOCK gives up after 10 s; keep waiting
+            try:
+                yield
+            finally:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+# --rotate closes the active results log into segments named after their
+# first row, <stem>.<YYYY-MM-DDTHHMMSS>[-N]<ext>, then compressed to
+# .gz or .zst; readers stream the segments, oldest first, before the log
+COMPRESSIONS = {"gzip": ".gz", "zstd": ".zst", "none": ""}
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ValueError("zstd compression needs zstandard (pip install zstandard)") from None
+    return zstandard
+
+def _segment_files(path):
+    """All closed segment files of the log at path as ((stamp, counter), file path, suffix), unsorted."""
+    folder = os.path.dirname(path) or "."
+    stem, ext = os.path.splitext(os.path.basename(path))
+    pattern = re.compile(re.escape(stem) + r"\.(\d{4}-\d\d-\d\dT\d{6})(?:-(\d+))?" + re.escape(ext) + r"(\.gz|\.zst)?$")
+    try:
+        names = os.listdir(folder)
+    except FileNotFoundError:
+        return []
+    files = []
+    for name in names:
+        m = pattern.match(name)
+        if m:
+            files.append(((m.group(1), int(m.group(2) or 0)), os.path.join(folder, name), m.group(3) or ""))
+    return files
+
+def log_segments(path):
+    """
+    The closed segments of the results log at path, oldest first, as
+    (timestamp of their first row to the second, file path) pairs.
+    """
+    found = {}
+    for key, segment, suffix in _segment_files(path):
+        # a compressed copy only gets its name once complete, so it wins
+        # over the original a compressing writer hasn't removed yet
+        if key not in found or suffix:
+            found[key] = segment
+    return [(f"{stamp[:13]}:{stamp[13:15]}:{stamp[15:]}", found[stamp, n]) for stamp, n in sorted(found)]
+
+def _open_segment(path):
+    """Open a log segment for reading bytes, decompressing .gz and .zst ones as they are read."""
+    if not path.endswith((".gz", ".zst")) and not os.path.exists(path):
+        # compressed since it was listed
+        path = next((path + suffix for suffix in (".gz", ".zst") if os.path.exists(path + suffix)), path)
+    if path.endswith(".gz"):
+        import gzip
+
+        return gzip.open(path, "rb")
+    if path.endswith(".zst"):
+        return io.BufferedReader(_zstandard().ZstdDecompressor().stream_reader(open(path, "rb")))
+    return open(path, "rb")
+
+def log_header(path):
+    """
+    The columns of the results log at path: its own header, then any other
+    columns of its rotated segments, which may predate a header migration.
+    """
+    header = []
+    for log in [path] + [segment for _, segment in reversed(log_segments(path))]:
+        try:
+            with _open_segment(log) as f:
+                columns = next(csv.reader([f.readline().decode("utf-8")]), [])
+        except FileNotFoundError:
+            continue
+        header += [c for c in columns if c not in header]
+    return header
+
+def _first_timestamp(path):
+    """The timestamp of the first row of the CSV at path, "" if it has none."""
+    with open(path, "rb") as f:
+        reader = _read_rows(f)
+        header = next(reader, [])
+        fields = next(reader, [])
+    if "timestamp" not in header or len(fields) <= header.index("timestamp"):
+        return ""
+    return fields[header.index("timestamp")]
+
+def _rotate_csv(path, rotate, rows):
+    """
+    Close the log at path into a segment before rows are appended if rotate
+    says so: "day" once rows start a new UTC day, a size in bytes once the
+    log has reached it. The last row of each device goes to a small JSON
+    file beside the segment, so latest_results() needn't read it. Returns
+    the segment's path, or None. The caller holds lock_file(path).
+    """
+    try:
+        size = os.path.getsize(path)
+    except FileNotFoundError:
+        return None
+    first = _first_timestamp(path) if size else ""
+    if not first:
+        return None  # nothing logged yet
+    if rotate == "day":
+        if first[:10] >= str(rows[0].get("timestamp") or "")[:10]:
+            return None
+    elif size < rotate:
+        return None
+    try:
+        stamp = _utc_timestamp(_parse_timestamp(first))
+    except ValueError:
+        stamp = _utc_timestamp(datetime.fromtimestamp(os.path.getmtime(path), timezone.utc))
+    stamp = stamp[:11] + stamp[11:19].replace(":", "")
+    stem, ext = os.path.splitext(path)
+    taken = {key for key, _, _ in _segment_files(path)}
+    n = 0
+    while (stamp, n) in taken:
+        n += 1
+    segment = f"{stem}.{stamp}{f'-{n}' if n else ''}{ext}"
+    latest_path = _segment_latest_path(segment)
+    with open(latest_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(_latest_rows(path), f)
+    os.replace(latest_path + ".tmp", latest_path)
+    os.replace(path, segment)
+    # the next write starts a new log, with a new index
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(path + ".idx")
+    _index_cache.pop(path, None)
+    _header_cache.pop(path, None)
+    return segment
+
+def compress_segments(path, compression="gzip"):
+    """
+    Compress the closed segments of the log at path that aren't yet, with
+    gzip or zstd, replacing the originals. Several processes may do so at
+    once: each writes its own temporary file and the first one done is kept.
+    """
+    suffix = COMPRESSIONS[compression]
+    if not suffix:
+        return
+    files = _segment_files(path)
+    compressed = {key for key, _, found in files if found}
+    for key, segment, found in files:
+        if found:
+            continue
+        if key not in compressed:
+            tmp_path = f"{segment}{suffix}.{os.getpid()}.tmp"
+            try:
+                with open(segment, "rb") as src:
+                    if compression == "zstd":
+                        dst = _zstandard().ZstdCompressor().stream_writer(open(tmp_path, "wb"))
+                    else:
+                        import gzip
+
+                        dst = gzip.open(tmp_path, "wb", compresslevel=6)
+                    with dst:
+                        while chunk := src.read(1024 * 1024):
+                            dst.write(chunk)
+            except FileNotFoundError:
+                continue  # another process got there first
+            if os.path.exists(segment + suffix):
+                os.remove(tmp_path)
+            else:
+                os.replace(tmp_path, segment + suffix)
+        # a reader may still hold it open on Windows; the next pass retries
+        with contextlib.suppress(OSError):
+            os.remove(segment)
+
+def write_csv(path, row, fieldnames, rollups=False, rotate=None, compression="gzip"):
+    write_csv_rows(path, [row], fieldnames, rollups, rotate, compression)
+
+def write_csv_rows(path, rows, fieldnames, rollups=False, rotate=None, compression="gzip"):
+    """
+    Append several rows with a single header check and a single write, and
+    record where each new (device, day) starts in the sidecar index
+    path + ".idx", a CSV of device, day, byte offset, used by iter_results()
+    and latest_results() to seek instead of scanning. With rollups, the
+    hourly and daily rollups in path + ".rollups" are updated too. Writers
+    in several processes take turns through lock_file(path), so their rows
+    neither interleave nor get lost in a header migration. With rotate,
+    "day" or a size in bytes, the log is first closed into a segment when
+    due (see _rotate_csv) and the segment compressed after the lock is
+    released; a header migration then only rewrites the active segment.
+    """
+    folder = os.path.dirname(path)
+    if folder and not os.path.exists(folder):
+        os.makedirs(folder, exist_ok=True)
+
+    # one writer at a time, across processes: the header check, append,
+    # index and rollups all read what the previous writer left
+    with lock_file(path):
+        segment = _rotate_csv(path, rotate, rows) if rotate else None
+        # If file exists but header is missing 'device', fix it first. Only the
+        # first line is read, so appending stays O(1) in the size of the file.
+        header = _ensure_csv_has_header(path, fieldnames, device_default="")
+
+        # encode here so the byte offset of every row is known
+        buf = io.StringIO()
+        # write in the file's own column order, which may differ from ours
+        # rows may carry more keys than the log keeps (e.g. timings)
+        writer = csv.DictWriter(buf, fieldnames=header or fieldnames, extrasaction="ignore")
+        if not header:
+            writer.writeheader()
+        data = bytearray(buf.getvalue().encode("utf-8"))
+        entries = []
+        for row in rows:
+            buf.seek(0)
+            buf.truncate()
+            writer.writerow(row)
+            entries.append((row.get("device") or "", str(row.get("timestamp") or "")[:10], len(data)))
+            data += buf.getvalue().encode("utf-8")
+        with open(path, "ab") as f:
+            base = f.tell()
+            f.write(data)
+        _update_csv_index(path, [(device, day, base + offset) for device, day, offset in entries], created=not header)
+        if rollups:
+            # a rotated log keeps its rollups
+            update_rollups(path, rows, created=not header and not segment)
+        if not header:
+            st = os.stat(path)
+            _header_cache[path] = (st.st_dev, st.st_ino, list(fieldnames))
+    if segment:
+        compress_segments(path, compression)
+
+# rows are appended in time order, give or take concurrent measurements, so
+# readers seek to READ_SLACK_S before the window and scan until that far past it
+READ_SLACK_S = 3600
+# below this many bytes the timestamp search reads lines instead of bisecting
+_SEEK_SCAN_BYTES = 64 * 1024
+
+def _utc_timestamp(dt):
+    """Format an aware or naive (taken as UTC) datetime like the logged timestamps."""
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+def _parse_timestamp(text):
+    # fromisoformat() only takes a "Z" suffix from Python 3.11 on
+    return datetime.fromisoformat(text[:-1] + "+00:00" if text.endswith("Z") else text)
+
+def _seek_timestamp(f, target, column, lo, hi):
+    """
+    Return an offset in the binary file f, at or before the first line
+    between lo (a line start) and hi whose timestamp column is >= target,
+    by bisecting on byte offsets. Needs one-line rows in time order.
+    """
+    while hi - lo > _SEEK_SCAN_BYTES:
+        mid = (lo + hi) // 2
+        f.seek(mid)
+        f.readline()  # finish the line mid falls in
+        line = f.readline()
+        fields = next(csv.reader([line.decode("utf-8", "replace")]), [])
+        if not line or (len(fields) > column and fields[column] >= target):
+            hi = mid
+        else:
+            lo = f.tell()
+    return lo
+
+def _read_rows(f):
+    """csv.reader over the binary file f from its current position."""
+    return csv.reader(line.decode("utf-8") for line in f)
+
+def _as_dict(header, fields):
+    # like csv.DictReader: missing fields are None
+    return dict(itertools.zip_longest(header, fields[:len(header)]))
+
+def _row_at(f, offset, header):
+    """The row starting exactly at offset in f, or None if offset isn't a line start."""
+    if offset > 0:
+        f.seek(offset - 1)
+        if f.read(1) != b"\n":
+            return None
+    f.seek(offset)
+    fields = next(_read_rows(f), None)
+    return _as_dict(header, fields) if fields is not None else None
+
+def _indexed_days(f, path, header, device, start, end):
+    """
+    The (day, offset) index entries of device within the window, or None
+    when there is no index or it doesn't match the file (checked at the
+    first and last entry).
+    """
+    index = _read_csv_index(path)
+    if not index:
+        return None
+    first_day = _utc_timestamp(_parse_timestamp(start) - timedelta(seconds=READ_SLACK_S))[:10] if start else ""
+    days = sorted((day, offset) for (d, day), offset in index.items()
+                  if d == device and day >= first_day and (not end or day <= end[:10]))
+    for day, offset in days[:1] + days[-1:]:
+        row = _row_at(f, offset, header)
+        if not row or row.get("device") != device or (row.get("timestamp") or "")[:10] != day:
+            return None
+    return days
+
+def _row_filter(header, device, start, end, server, columns):
+    """match(fields) for rows of a log with this header, as iter_results() filters and shapes them."""
+    width = len(header)
+    ts_col = header.index("timestamp")
+    device_col = header.index("device") if "device" in header else None
+    server_col = header.index("server_id") if "server_id" in header else None
+    if columns is not None:
+        picks = [header.index(c) if c in header else width for c in columns]
+
+    def match(fields):
+        # short rows are padded so every column lookup works
+        fields += [""] * (width + 1 - len(fields))
+        ts = fields[ts_col]
+        if start and ts < start or end and ts >= end:
+            return None
+        if device is not None and (device_col is None or fields[device_col] != device):
+            return None
+        if server is not None and (server_col is None or fields[server_col] != str(server)):
+            return None
+        if columns is not None:
+            return tuple(fields[i] for i in picks)
+        return _as_dict(header, fields[:width])
+
+    return match
+
+def _iter_segment(segment, device, start, end, server, columns):
+    """Yield the matching rows of a closed segment of a log, scanning it from the start."""
+    with _open_segment(segment) as f:
+        header = next(csv.reader([f.readline().decode("utf-8")]), [])
+        if "timestamp" not in header:
+            return
+        ts_col = header.index("timestamp")
+        match = _row_filter(header, device, start, end, server, columns)
+        stop_at = _utc_timestamp(_parse_timestamp(end) + timedelta(seconds=READ_SLACK_S)) if end else None
+        for fields in _read_rows(f):
+            if stop_at and len(fields) > ts_col and fields[ts_col] >= stop_at:
+                break
+            row = match(fields)
+            if row is not None:
+                yield row
+
+def iter_results(path, device=None, start=None, end=None, server=None, columns=None):
+    """
+    Yield the rows of the results CSV at path as dicts of strings, lazily,
+    keeping only those of device, with start <= timestamp < end (datetimes
+    or timestamp strings as logged) and server_id server. With a device and
+    the sidecar index (see write_csv_rows), only that device's days are
+    read; otherwise, with start, the first row is found by a binary search
+    over the file, so the part of a long history before the window isn't
+    read at all. With columns, rows are tuples of those columns instead
+    ("" where the log lacks one), which skips building a dict per row.
+    The closed segments of a rotated log come first, as if all were one
+    file; those wholly outside the window, going by the first rows their
+    names carry, aren't opened.
+    """
+    start = _utc_timestamp(start) if isinstance(start, datetime) else start
+    end = _utc_timestamp(end) if isinstance(end, datetime) else end
+    segments = log_segments(path)
+    if segments:
+        # the same READ_SLACK_S leeway as below
+        after = _utc_timestamp(_parse_timestamp(start) - timedelta(seconds=READ_SLACK_S)) if start else ""
+        before = _utc_timestamp(_parse_timestamp(end) + timedelta(seconds=READ_SLACK_S)) if end else None
+        for i, (first, segment) in enumerate(segments):
+            if before and first >= before:
+                return  # neither this segment nor the log has rows that early
+            # a segment ends where the next one starts
+            if i + 1 < len(segments) and segments[i + 1][0] < after:
+                continue
+            yield from _iter_segment(segment, device, start, end, server, columns)
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        return
+    with f:
+        header = next(csv.reader([f.readline().decode("utf-8")]), [])
+        if "timestamp" not in header:
+            return
+        ts_col = header.index("timestamp")
+        match = _row_filter(header, device, start, end, server, columns)
+
+        days = _indexed_days(f, path, header, device, start, end) if device is not None else None
+        if days is not None:
+            for day, offset in days:
+                # a day's rows follow its first one, give or take READ_SLACK_S
+                stop_at = _utc_timestamp(_parse_timestamp(day) + timedelta(days=1, seconds=READ_SLACK_S))
+                f.seek(offset)
+                for fields in _read_rows(f):
+                    ts = fields[ts_col] if len(fields) > ts_col else ""
+                    if ts >= stop_at:
+                        break
+                    if ts[:10] == day:
+                        row = match(fields)
+                        if row is not None:
+                            yield row
+            return
+
+        # fuzzy bounds: rows within READ_SLACK_S may be out of order
+        stop_at = None
+        if start:
+            seek_to = _utc_timestamp(_parse_timestamp(start) - timedelta(seconds=READ_SLACK_S))
+            f.seek(_seek_timestamp(f, seek_to, ts_col, f.tell(), os.fstat(f.fileno()).st_size))
+        if end:
+            stop_at = _utc_timestamp(_parse_timestamp(end) + timedelta(seconds=READ_SLACK_S))
+        for fields in _read_rows(f):
+            if stop_at and len(fields) > ts_col and fields[ts_col] >= stop_at:
+                break
+            row = match(fields)
+            if row is not None:
+                yield row
+
+def _segment_latest_path(segment):
+    # next to the segment, named after it before compression
+    for suffix in (".gz", ".zst"):
+        if segment.endswith(suffix):
+            segment = segment[:-len(suffix)]
+    return segment + ".latest.json"
+
+def latest_results(path):
+    """
+    Return {device: its most recent row} from the results CSV at path.
+    With the sidecar index, only each device's last logged day is read,
+    from where it starts, so a device that stopped logging long ago doesn't
+    make the others scan the rest of the log. The closed segments of a
+    rotated log contribute the last rows recorded when they were closed
+    (see _rotate_csv); one without that record is read in full.
+    """
+    latest = {}
+    for _, segment in log_segments(path):
+        try:
+            with open(_segment_latest_path(segment), encoding="utf-8") as f:
+                rows = list(json.load(f).values())
+        except (OSError, ValueError, AttributeError):
+            rows = _iter_segment(segment, None, None, None, None, None)
+        for row in rows:
+            key = row.get("device") or ""
+            if key not in latest or (row.get("timestamp") or "") >= (latest[key].get("timestamp") or ""):
+                latest[key] = row
+    for key, row in _latest_rows(path).items():
+        if key not in latest or (row.get("timestamp") or "") >= (latest[key].get("timestamp") or ""):
+            latest[key] = row
+    return latest
+
+def _latest_rows(path):
+    """latest_results() of the CSV at path alone, leaving out its rotated segments."""
+    latest = {}
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        return latest
+    with f:
+        header = next(csv.reader([f.readline().decode("utf-8")]), [])
+        if "timestamp" not in header:
+            return latest
+        ts_col = header.index("timestamp")
+        device_col = header.index("device") if "device" in header else None
+        last_days = {}
+        for (device, day), offset in _read_csv_index(path).items():
+            if day >= last_days.get(device, ("", 0))[0]:
+                last_days[device] = (day, offset)
+
+        def newer(newest, fields, device=None):
+            # keep fields if they are their device's newest row so far; with device, only its rows count
+            if len(fields) <= ts_col:
+                return
+            key = fields[device_col] if device_col is not None and len(fields) > device_col else ""
+            if (device is None or key == device) and (key not in newest or fields[ts_col] >= newest[key][ts_col]):
+                newest[key] = fields
+
+        newest = {}
+        for device, (day, offset) in last_days.items():
+            row = _row_at(f, offset, header)
+            try:
+                # a day's rows follow its first one, give or take READ_SLACK_S
+                stop_at = _utc_timestamp(_parse_timestamp(day) + timedelta(days=1, seconds=READ_SLACK_S))
+            except ValueError:
+                row = None
+            if not row or row.get("device") != device:
+                last_days = {}  # stale index: read everything
+                break
+            f.seek(offset)
+            for fields in _read_rows(f):
+                if len(fields) > ts_col and fields[ts_col] >= stop_at:
+                    break
+                newer(newest, fields, device)
+        if not last_days:
+            newest = {}
+            f.seek(0)
+            f.readline()
+            for fields in _read_rows(f):
+                newer(newest, fields)
+    return {key: _as_dict(header, fields) for key, fields in newest.items()}
+
+# what the stats subcommand summarizes, and the percentiles it reports
+STATS_METRICS = ["download_mbps", "upload_mbps", "ping_ms"]
+STATS_PERCENTILES = [5, 50, 95, 99]
+# timestamp prefix that names each --period
+STATS_PERIODS = {"all": 0, "year": 4, "month": 7, "day": 10}
+_STATS_CHUNK_ROWS = 65536
+
+def compute_stats(path, by=("device",), period="all", device=None, start=None, end=None, server=None):
+    """
+    Summarize STATS_METRICS of the results CSV at path per group of the
+    by columns (and per period, see STATS_PERIODS), over the rows
+    iter_results() selects: a list of dicts holding the group columns,
+    "period", "count", and "<metric>_mean", "_median" and "_p<N>" for
+    each of STATS_PERCENTILES, sorted by group. Columns are read in chunks
+    into NumPy arrays and reduced there. Unless grouped or filtered by
+    server, --servers "aggregate" rows are left out so runs count once.
+    Needs numpy.
+    """
+    import warnings
+
+    try:
+        import numpy as np
+    except ImportError:
+        raise ValueError("The stats subcommand needs numpy (pip install numpy)") from None
+
+    by = list(by)
+    prefix = STATS_PERIODS[period]
+    skip_aggregate = server is None and "server_id" not in by
+    columns = by + ["timestamp", "server_id"] + STATS_METRICS
+    records = iter_results(path, device, start, end, server, columns=columns)
+    groups = {}  # (group values..., period) -> group number
+    group_chunks, value_chunks = [], []
+    while True:
+        chunk = list(itertools.islice(records, _STATS_CHUNK_ROWS))
+        if not chunk:
+            break
+        if skip_aggregate:
+            chunk = [r for r in chunk if r[len(by) + 1] != "aggregate"]
+            if not chunk:
+                continue
+        cols = list(zip(*chunk))
+        keys = zip(*cols[:len(by)], (ts[:prefix] for ts in cols[len(by)]))
+        group_chunks.append(np.fromiter((groups.setdefault(k, len(groups)) for k in keys), dtype=np.int64, count=len(chunk)))
+        values = np.array(cols[len(by) + 2:])
+        # failed or missing measurements are blank; they count as NaN
+        value_chunks.append(np.where(values == "", "nan", values).astype(np.float64).T)
+    if not groups:
+        return []
+
+    group_ids = np.concatenate(group_chunks)
+    values = np.concatenate(value_chunks)
+    order = np.argsort(group_ids, kind="stable")
+    group_ids, values = group_ids[order], values[order]
+    bounds = np.flatnonzero(np.diff(group_ids)) + 1
+    names = {number: key for key, number in groups.items()}
+    stats = []
+    for ids, block in zip(np.split(group_ids, bounds), np.split(values, bounds)):
+        key = names[int(ids[0])]
+        row = dict(zip(by, key[:-1]))
+        row["period"] = key[-1] or "all"
+        row["count"] = len(block)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", RuntimeWarning)  # a metric that is blank throughout is NaN
+            means = np.nanmean(block, axis=0)
+            quantiles = np.nanpercentile(block, STATS_PERCENTILES, axis=0)
+        for m, metric in enumerate(STATS_METRICS):
+            # None where the metric is blank throughout, e.g. failed runs
+            row[f"{metric}_mean"] = None if np.isnan(means[m]) else round(float(means[m]), 3)
+            for p, q in zip(STATS_PERCENTILES, quantiles[:, m]):
+                row[f"{metric}_{'median' if p == 50 else f'p{p}'}"] = None if np.isnan(q) else round(float(q), 3)
+        stats.append(row)
+    stats.sort(key=lambda r: [str(r[c]) for c in by] + [r["period"]])
+    return stats
+
+# hourly rollups older than this many days before the newest are dropped;
+# daily ones are kept
+ROLLUP_HOURLY_DAYS = 35
+# relative error of the quantiles the rollup sketches give
+SKETCH_ACCURACY = 0.01
+_SKETCH_GAMMA = (1 + SKETCH_ACCURACY) / (1 - SKETCH_ACCURACY)
+# timestamp prefix that names a bucket of each rollup resolution
+ROLLUP_RESOLUTIONS = {"hour": 13, "day": 10}
+
+def _sketch_add(sketch, value):
+    # log-spaced buckets: value falls in gamma**(k-1) < value <= gamma**k
+    key = str(math.ceil(math.log(value, _SKETCH_GAMMA))) if value > 0 else "zero"
+    sketch[key] = sketch.get(key, 0) + 1
+
+def sketch_quantile(sketch, q):
+    """Estimate the q (0..1) quantile of the values added to a rollup sketch, within SKETCH_ACCURACY."""
+    buckets = sorted((float("-inf") if k == "zero" else int(k), n) for k, n in sketch.items())
+    rank = q * (sum(n for _, n in buckets) - 1)
+    seen = 0
+    for k, n in buckets:
+        seen += n
+        if seen > rank:
+            return 0.0 if k == float("-inf") else 2 * _SKETCH_GAMMA ** k / (_SKETCH_GAMMA + 1)
+    return None
+
+# rollups live in path + ".rollups/<resolution>/<device>/<file>.json", one
+# file per device and ROLLUP_FILES prefix of the buckets (a day of hours, a
+# month of days), so a write only rewrites the files of its buckets
+ROLLUP_FILES = {"hour": 10, "day": 7}
+
+def _rollup_dir(path, resolution, device):
+    # "@" can't come out of quote(), so it stands for rows without a device
+    return os.path.join(path + ".rollups", resolution, quote(device, safe="") or "@")
+
+def _load_rollup_file(path):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f).get("buckets", {})
+    except (OSError, ValueError, AttributeError):
+        return {}
+
+def _save_rollup_file(path, device, buckets):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        # dumps() uses the C encoder, dump() doesn't
+        f.write(json.dumps({"device": device, "buckets": buckets}, separators=(",", ":")))
+    os.replace(tmp_path, path)
+
+def _rollup_add(files, device, timestamp, values):
+    """
+    Add one row's STATS_METRICS values (numbers or logged strings) to the
+    buckets of every resolution in files, {(resolution, device, file
+    name): buckets}, whose entries are loaded by the caller.
+    """
+    for resolution, prefix in ROLLUP_RESOLUTIONS.items():
+        buckets = files[(resolution, device, timestamp[:ROLLUP_FILES[resolution]])]
+        bucket = buckets.setdefault(timestamp[:prefix], {})
+        for metric, value in zip(STATS_METRICS, values):
+            if value in ("", None):
+                continue
+            value = float(value)
+            agg = bucket.get(metric)
+            if agg is None:
+                bucket[metric] = agg = {"count": 0, "sum": 0.0, "min": value, "max": value, "sketch": {}}
+            agg["count"] += 1
+            agg["sum"] += value
+            agg["min"] = min(agg["min"], value)
+            agg["max"] = max(agg["max"], value)
+            _sketch_add(agg["sketch"], value)
+
+def _save_rollups(path, files):
+    for (resolution, device, name), buckets in files.items():
+        _save_rollup_file(os.path.join(_rollup_dir(path, resolution, device), name + ".json"), device, buckets)
+    # hourly files older than ROLLUP_HOURLY_DAYS before the newest are dropped
+    newest = max((name for resolution, _, name in files if resolution == "hour"), default=None)
+    if newest is None:
+        return
+    cutoff = (_parse_timestamp(newest) - timedelta(days=ROLLUP_HOURLY_DAYS)).strftime("%Y-%m-%d")
+    for device in {device for _, device, _ in files}:
+        folder = _rollup_dir(path, "hour", device)
+        for entry in os.listdir(folder):
+            if entry.endswith(".json") and entry[:-5] < cutoff:
+                os.remove(os.path.join(folder, entry))
+
+def rebuild_rollups(path):
+    """Compute the rollups of the results CSV at path from scratch."""
+    import shutil
+
+    files = collections.defaultdict(dict)
+    for device, timestamp, server_id, *values in iter_results(path, columns=["device", "timestamp", "server_id", *STATS_METRICS]):
+        if server_id != "aggregate" and timestamp:
+            _rollup_add(files, device, timestamp, values)
+    shutil.rmtree(path + ".rollups", ignore_errors=True)
+    _save_rollups(path, files)
+
+def update_rollups(path, rows, created=False):
+    """
+    Add rows just appended to the results CSV at path to its rollups. As
+    in compute_stats(), --servers "aggregate" rows are left out. A log
+    without rollups yet (unless created says it is new) is rolled up from
+    the start once.
+    """
+    if created:
+        import shutil
+
+        shutil.rmtree(path + ".rollups", ignore_errors=True)  # left from an earlier log
+    elif not os.path.isdir(path + ".rollups"):
+        rebuild_rollups(path)  # the log already holds rows
+        return
+    files = {}
+    for row in rows:
+        if str(row.get("server_id")) == "aggregate" or not row.get("timestamp"):
+            continue
+        device, timestamp = row.get("device") or "", str(row["timestamp"])
+        for resolution in ROLLUP_RESOLUTIONS:
+            key = (resolution, device, timestamp[:ROLLUP_FILES[resolution]])
+            if key not in files:
+                files[key] = _load_rollup_file(os.path.join(_rollup_dir(path, *key[:2]), key[2] + ".json"))
+        _rollup_add(files, device, timestamp, [row.get(m) for m in STATS_METRICS])
+    _save_rollups(path, files)
+
+def read_rollups(path, resolution="day", device=None, start=None, end=None):
+    """
+    Return the rollups of the results CSV at path at resolution ("hour"
+    or "day"), for device and buckets from start's to before end's if
+    given, as dicts of device, bucket, metric, count, sum, mean, min, max
+    and the sketch's p5, median, p95 and p99, sorted. Only the rollup
+    files covering the window are read.
+    """
+    prefix, file_prefix = ROLLUP_RESOLUTIONS[resolution], ROLLUP_FILES[resolution]
+    first = start[:prefix] if start else ""
+    try:
+        folders = sorted(os.listdir(os.path.join(path + ".rollups", resolution)))
+    except FileNotFoundError:
+        return []
+    out = []
+    for folder in folders:
+        dev = "" if folder == "@" else unquote(folder)
+        if device is not None and dev != device:
+            continue
+        names = sorted(n[:-5] for n in os.listdir(os.path.join(path + ".rollups", resolution, folder)) if n.endswith(".json"))
+        for name in names:
+            if name < first[:file_prefix] or end and name > end[:file_prefix]:
+                continue
+            buckets = _load_rollup_file(os.path.join(path + ".rollups", resolution, folder, name + ".json"))
+            for bucket, metrics in sorted(buckets.items()):
+                if bucket < first or end and bucket >= end[:prefix]:
+                    continue
+                for metric in STATS_METRICS:
+                    agg = metrics.get(metric)
+                    if not agg:
+                        continue
+                    row = {"device": dev, "bucket": bucket, "metric": metric, "count": agg["count"],
+                           "sum": round(agg["sum"], 3), "mean": round(agg["sum"] / agg["count"], 3),
+                           "min": agg["min"], "max": agg["max"]}
+                    for p in STATS_PERCENTILES:
+                        # a bucket's estimate may lie just outside the exact extremes
+                        q = min(max(sketch_quantile(agg["sketch"], p / 100), agg["min"]), agg["max"])
+                        row["median" if p == 50 else f"p{p}"] = round(q, 3)
+                    out.append(row)
+    return out
+
+# columns stored as numbers by typed backends; everything else is text
+NUMERIC_FIELDS = {"lat", "lon", "ping_ms", "download_mbps", "upload_mbps", *TIMING_FIELDS, *LATENCY_FIELDS}
+# the numeric columns that hold counts
+INTEGER_FIELDS = {"bytes_received", "bytes_sent", "download_threads", "upload_threads", "latency_samples", "latency_lost"}
+
+class CsvStore:
+    """
+    Result store appending to a CSV file through write_csv_rows, optionally
+    keeping its rollups and rotating it ("day" or a size in bytes) into
+    segments compressed with gzip, zstd (needs zstandard) or not at all.
+    """
+
+    def __init__(self, path, fieldnames, rollups=False, rotate=None, compression="gzip"):
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"Unsupported compression: {compression}")
+        if rotate and compression == "zstd":
+            _zstandard()
+        self.path = path
+        self.fieldnames = list(fieldnames)
+        self.rollups = rollups
+        self.rotate = rotate
+        self.compression = compression
+        self.location = os.path.abspath(path)
+
+    def write_many(self, rows):
+        write_csv_rows(self.path, rows, self.fieldnames, self.rollups, self.rotate, self.compression)
+
+    def close(self):
+        pass
+
+class SqliteStore:
+    """
+    Result store keeping rows in an indexed SQLite table.
+
+    WAL mode lets readers query while a run writes, and a busy timeout makes
+    concurrent runs queue up instead of failing. Each write_many call is one
+    transaction.
+    """
+
+    def __init__(self, path, fieldnames, table="results"):
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder, exist_ok=True)
+        self.path = path
+        self.table = table
+        self.fieldnames = list(fieldnames)
+        self.location = os.path.abspath(path)
+        import sqlite3
+
+        # autocommit mode; transactions are opened explicitly in write_many
+        self.conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self._ensure_schema()
+
+    def _ensure_schema(self):
+        def coltype(fn):
+            if fn in INTEGER_FIELDS:
+                return "INTEGER"
+            return "REAL" if fn in NUMERIC_FIELDS else "TEXT"
+
+        cols = ", ".join(f'"{fn}" {coltype(fn)}' for fn in self.fieldnames)
+        self.conn.execute(f'CREATE TABLE IF NOT EXISTS "{self.table}" (id INTEGER PRIMARY KEY, {cols})')
+        # older databases may lack columns added since; add them in place
+        existing = {r[1] for r in self.conn.execute(f'PRAGMA table_info("{self.table}")')}
+        for fn in self.fieldnames:
+            if fn not in existing:
+                self.conn.execute(f'ALTER TABLE "{self.table}" ADD COLUMN "{fn}" {coltype(fn)}')
+        for name, cols in (("device_ts", "device, timestamp"),
+                           ("ts", "timestamp"),
+                           ("server_ts", "server_id, timestamp")):
+            self.conn.execute(f'CREATE INDEX IF NOT EXISTS "{self.table}_{name}" ON "{self.table}" ({cols})')
+
+    def write_many(self, rows):
+        cols = ", ".join(f'"{fn}"' for fn in self.fieldnames)
+        marks = ", ".join("?" for _ in self.fieldnames)
+        # blanks are NULL, as in ParquetStore, so REAL columns hold no '' text
+        values = [[None if r.get(fn) == "" else r.get(fn) for fn in self.fieldnames] for r in rows]
+        # take the write lock up front so concurrent writers wait on busy_timeout
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            self.conn.executemany(f'INSERT INTO "{self.table}" ({cols}) VALUES ({marks})', values)
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.conn.execute("COMMIT")
+
+    def close(self):
+        self.conn.close()
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ValueError("The parquet store needs pyarrow (pip install pyarrow)") from None
+    return pyarrow
+
+class ParquetStore:
+    """
+    Result store appending to a Parquet dataset partitioned by device and
+    day (root/device=X/date=YYYY-MM-DD/*.parquet), with typed columns:
+    timestamp as UTC timestamps, NUMERIC_FIELDS as doubles (INTEGER_FIELDS
+    as int64), the rest as strings. Each partition is kept as a single
+    file, rewritten with the new rows on every write, so a day of one row
+    per cron tick doesn't leave hundreds of tiny files behind (files left
+    by earlier writers are merged in too). Needs pyarrow.
+    """
+
+    def __init__(self, path, fieldnames):
+        pyarrow = self.pa = _pyarrow()
+        self.pq = pyarrow.parquet
+        self.path = path
+        self.fieldnames = list(fieldnames)
+        self.location = os.path.abspath(path)
+
+        def coltype(fn):
+            if fn == "timestamp":
+                return pyarrow.timestamp("us", tz="UTC")
+            if fn in INTEGER_FIELDS:
+                return pyarrow.int64()
+            return pyarrow.float64() if fn in NUMERIC_FIELDS else pyarrow.string()
+
+        self.schema = pyarrow.schema([(fn, coltype(fn)) for fn in self.fieldnames] + [("date", pyarrow.string())])
+
+    def _value(self, fn, v):
+        if v is None or v == "":
+            return None
+        if fn == "timestamp":
+            return datetime.fromisoformat(v.replace("Z", "+00:00"))
+        if fn in INTEGER_FIELDS:
+            return int(v)
+        return float(v) if fn in NUMERIC_FIELDS else str(v)
+
+    def write_many(self, rows):
+        partitions = collections.defaultdict(list)
+        for r in rows:
+            partitions[r.get("device") or "", str(r.get("timestamp", ""))[:10]].append(r)
+        for (device, date), part_rows in partitions.items():
+            self._write_partition(device, date, part_rows)
+
+    def _write_partition(self, device, date, rows):
+        # the hive layout write_to_dataset uses; partition values aren't stored in the files
+        folder = os.path.join(self.path, "device=" + (quote(device, safe="") or "__HIVE_DEFAULT_PARTITION__"),
+                              "date=" + (quote(date, safe="") or "__HIVE_DEFAULT_PARTITION__"))
+        fields = [fn for fn in self.fieldnames if fn != "device"]
+        table = self.pa.table({fn: [self._value(fn, r.get(fn)) for r in rows] for fn in fields},
+                              schema=self.pa.schema([self.schema.field(fn) for fn in fields]))
+        os.makedirs(folder, exist_ok=True)
+        # dataset readers skip names starting with "_" or "."
+        with lock_file(os.path.join(folder, "_partition")):
+            old = sorted(name for name in os.listdir(folder) if name.endswith(".parquet"))
+            tables = [self.pq.read_table(os.path.join(folder, name)) for name in old]
+            if tables:
+                # files from before a column was added lack it; it reads as null
+                table = self.pa.concat_tables(tables + [table], promote_options="default")
+            tmp_path = os.path.join(folder, f".part-{os.getpid()}.tmp")
+            self.pq.write_table(table, tmp_path)
+            os.replace(tmp_path, os.path.join(folder, "part-0.parquet"))
+            for name in old:
+                if name != "part-0.parquet":
+                    os.remove(os.path.join(folder, name))
+
+    def close(self):
+        pass
+
+class StoreGroup:
+    """Fans writes out to several stores, e.g. CSV plus Parquet."""
+
+    def __init__(self, stores):
+        self.stores = stores
+        self.location = ", ".join(st.location for st in stores)
+
+    def write_many(self, rows):
+        for st in self.stores:
+            st.write_many(rows)
+
+    def close(self):
+        for st in self.stores:
+            st.close()
+
+# how long a run waits on exit for spooled results to reach the stores, in seconds
+SPOOL_TIMEOUT = 30.0
+
+class SpooledStore:
+    """
+    Write-ahead spool in front of the result stores, for destinations on
+    slow or intermittently mounted shares. write_many only appends the rows
+    as JSON lines to spool_dir/results.jsonl on local disk, fsynced, each
+    with the columns of the run that wrote it, and wakes a background
+    thread that flushes them: it renames the spool to a numbered batch
+    file, so new rows start a fresh spool, writes each batch to the stores
+    opened by open_stores(columns) with the columns of all its rows (on
+    first use, again when those change and after a failure) and deletes
+    the batch only once the stores took it. Runs with different columns,
+    e.g. --latency-only and --timing-columns, can so share a spool. Rows that
+    can't be delivered stay spooled for the next flush, so delivery is
+    at least once: a run killed between the write and the delete sends its
+    batch again. A flush starts once batch rows are waiting, or an earlier
+    batch is still undelivered; close() waits up to timeout seconds for one
+    under way.
+    """
+
+    def __init__(self, spool_dir, open_stores, destination, fieldnames, batch=1, timeout=SPOOL_TIMEOUT):
+        os.makedirs(spool_dir, exist_ok=True)
+        self.path = os.path.join(spool_dir, "results.jsonl")
+        self.location = f"{os.path.abspath(self.path)} (spool for {destination})"
+        self.destination = destination
+        self.open_stores = open_stores
+        self.fieldnames = list(fieldnames)
+        self.batch = batch
+        self.timeout = timeout
+        self.store = None
+        self._store_fieldnames = None
+        self._closing = False
+        # requests to the flusher thread, the only one to touch the stores, and
+        # those handled; it catches up on all at once, flushing if any asked to
+        self._requested = self._done = 0
+        self._flush_wanted = False
+        self._cond = threading.Condition()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def write_many(self, rows):
+        # progress series go to their own sidecar and aren't stored
+        data = "".join(json.dumps({"fieldnames": self.fieldnames, "row": {k: v for k, v in row.items() if k != "progress"}})
+                       + "\n" for row in rows)
+        with lock_file(self.path):
+            with open(self.path, "a+", encoding="utf-8") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+                f.seek(0)
+                pending = sum(1 for _ in f)
+        if pending >= self.batch or self._batches():
+            self._request()
+
+    def _batches(self):
+        folder, name = os.path.split(self.path)
+        return sorted(os.path.join(folder, fn) for fn in os.listdir(folder)
+                      if fn.startswith(name + ".") and fn[len(name) + 1:].isdigit())
+
+    def _request(self, flush=True):
+        with self._cond:
+            self._flush_wanted |= flush
+            self._requested += 1
+            self._cond.notify_all()
+            return self._requested
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._requested > self._done)
+                target, flush, self._flush_wanted = self._requested, self._flush_wanted, False
+            try:
+                if flush:
+                    self._flush()
+            except OSError as e:
+                print(f"Flushing spooled results failed: {e}", flush=True)
+            if self._closing:
+                self._close_store()
+            with self._cond:
+                self._done = target
+                self._cond.notify_all()
+
+    def _flush(self):
+        # one flusher per spool across processes, so no batch is sent twice;
+        # a stuck one holds up the others, not their measurements
+        with lock_file(self.path + ".flush"):
+            with lock_file(self.path):
+                if os.path.exists(self.path) and os.path.getsize(self.path):
+                    os.replace(self.path, f"{self.path}.{time.time_ns()}")
+            for batch in self._batches():
+                rows = []
+                fieldnames = []
+                with open(batch, encoding="utf-8") as f:
+                    for line in f:
+                        try:
+                            entry = json.loads(line)
+                        except ValueError:
+                            # left by a run killed mid-append
+                            print(f"Skipping a damaged line in {batch}", flush=True)
+                            continue
+                        if "row" not in entry:
+                            entry = {"row": entry}  # spooled without its columns: take ours
+                        rows.append(entry["row"])
+                        fieldnames += [fn for fn in entry.get("fieldnames", self.fieldnames) if fn not in fieldnames]
+                try:
+                    if rows:
+                        if self.store is not None and fieldnames != self._store_fieldnames:
+                            self._close_store()
+                        if self.store is None:
+                            self.store = self.open_stores(fieldnames)
+                            self._store_fieldnames = fieldnames
+                        self.store.write_many(rows)
+                except Exception as e:
+                    print(f"Flushing spooled results to {self.destination} failed, they stay in {batch}: {e}", flush=True)
+                    self._close_store()  # reopen next time, e.g. once the share is back
+                    break
+                os.remove(batch)
+
+    def _close_store(self):
+        store, self.store = self.store, None
+        if store is not None:
+            with contextlib.suppress(Exception):
+                store.close()
+
+    def close(self):
+        # rows short of a batch stay spooled; a flush under way gets to finish
+        self._closing = True
+        target = self._request(flush=False)
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._done >= target, self.timeout):
+                print(f"Results not yet flushed to {self.destination} after {self.timeout:g} s stay spooled in "
+                      f"{os.path.dirname(self.path)}", flush=True)
+
+def _parse_store_url(url):
+    """(scheme, path) of a store URL for open_store(); a plain path is a CSV file."""
+    scheme, sep, rest = url.partition("://")
+    if not sep:
+        return "csv", url
+    if scheme not in ("csv", "sqlite", "parquet"):
+        raise ValueError(f"Unsupported store scheme: {scheme}")
+    # strip the empty host part: sqlite:///a.db -> a.db, sqlite:////a.db -> /a.db
+    return scheme, rest[1:] if rest.startswith("/") else rest
+
+def check_store(url, rotate=None, compression="gzip"):
+    """
+    Raise ValueError if open_store() couldn't open url for its scheme or a
+    missing optional package, without touching the store itself; --spool
+    only opens the stores when flushing, maybe once a share is back.
+    """
+    scheme, _ = _parse_store_url(url)
+    if scheme == "parquet":
+        _pyarrow()
+    elif scheme == "csv" and rotate and compression == "zstd":
+        _zstandard()
+
+def open_store(url, fieldnames, rollups=False, rotate=None, compression="gzip"):
+    """
+    Open a result store from a URL: csv:///path.csv, sqlite:///path.db or
+    parquet:///dataset-dir (relative; use four slashes for an absolute path,
+    as in SQLAlchemy). A plain path is treated as a CSV file. rollups,
+    rotate and compression apply to CSV stores.
+    """
+    scheme, path = _parse_store_url(url)
+    if scheme == "csv":
+        return CsvStore(path, fieldnames, rollups, rotate, compression)
+    if scheme == "sqlite":
+        return SqliteStore(path, fieldnames)
+    return ParquetStore(path, fieldnames)
+
+def choose_device_interactive(devices):
+    while True:
+        print("Select device:")
+        for i, d in enumerate(devices, 1):
+            print(f"{i}. {d}")
+        sel = input("Enter number or name (leave empty for UNKNOWN): ").strip()
+        if not sel:
+            return "UNKNOWN"
+        if sel.isdigit():
+            idx = int(sel)
+            if 1 <= idx <= len(devices):
+                return devices[idx - 1]
+        elif sel in devices:
+            return sel
+        print("Invalid selection, try again.")
+
+# a daemon rebuilds its client this often to pick up config and server changes
+DAEMON_CLIENT_MAX_AGE = 24 * 3600
+
+def print_result(store, row):
+    print(f"Saved results to {store.location}")
+    # flush so daemon output reaches log files as it happens
+    if "latency_samples" in row:
+        row = {fn: "" if v is None else v for fn, v in row.items()}
+        print(f"Device: {row['device']} — Ping: {row['ping_ms']} ms (min {row['latency_min_ms']}, p95 {row['latency_p95_ms']}), "
+              f"Jitter: {row['latency_jitter_ms']} ms, Loss: {row['latency_loss_pct']}%", flush=True)
+        return
+    print(f"Device: {row['device']} — Download: {row['download_mbps']} Mbps, Upload: {row['upload_mbps']} Mbps, Ping: {row['ping_ms']} ms", flush=True)
+
+def load_device_config(path):
+    """
+    Read per-device settings from a JSON object keyed by device name, e.g.
+    {"TUCMOTO5": {"source_address": "192.168.5.10"}}. Devices are bound to an
+    interface through that interface's address.
+    """
+    if not path:
+        return {}
+    with open(path, encoding="utf-8") as f:
+        config = json.load(f)
+    if not isinstance(config, dict):
+        raise ValueError(f"{path}: expected an object keyed by device name")
+    return config
+
+def _device_row(device, row, timings, progress):
+    row = {"device": device, **row, **timings}
+    if progress is not None:
+        row["progress"] = progress
+    return row
+
+def aggregate_row(rows):
+    """
+    Combine the rows of servers tested at the same time into one row for
+    the whole link: summed throughput and bytes, lowest ping, and
+    server_id "aggregate".
+    """
+    first = rows[0]
+    # None, not "": typed stores keep the numeric columns numeric; CSV writes it empty
+    row = dict.fromkeys(FIELDNAMES)
+    row.update(
+        device=first["device"],
+        timestamp=first["timestamp"],
+        server_id="aggregate",
+        server_name=f"{len(rows)} servers",
+        host=" ".join(str(r["host"]) for r in rows),
+        ping_ms=min(r["ping_ms"] for r in rows),
+        download_mbps=round(sum(r["download_mbps"] for r in rows), 3),
+        upload_mbps=round(sum(r["upload_mbps"] for r in rows), 3),
+        client_ip=first["client_ip"],
+        client_isp=first["client_isp"],
+    )
+    for fn in ("bytes_received", "bytes_sent", "download_threads", "upload_threads"):
+        if all(fn in r for r in rows):
+            row[fn] = sum(r[fn] for r in rows)
+    return row
+
+def _session_client(session, source_address, timings=None):
+    """
+    The speedtest client kept in a measure() session, created on first use
+    and again once DAEMON_CLIENT_MAX_AGE old, when the --servers clients
+    kept with it are dropped too.
+    """
+    s = session.get("client")
+    if s is None or time.monotonic() - session["created"] > DAEMON_CLIENT_MAX_AGE:
+        s = new_client(source_address, timings)
+        session.update(client=s, created=time.monotonic(), server_clients=[])
+    return s
+
+def _measure_server(device, args, source_address, server, clients, i):
+    # one of several concurrent --servers tests; gets its own client, kept
+    # in clients[i] for the next measurement
+    timings = {}
+    progress = {} if args.progress else None
+    if clients[i] is None:
+        clients[i] = new_client(source_address, timings)
+    try:
+        row = run_speedtest(clients[i], None, 0, source_address, timings, progress, args.progress_interval, server,
+                            args.tuning)
+    except Exception:
+        clients[i] = None  # start over with fresh config next time
+        raise
+    return _device_row(device, row, timings, progress)
+
+def measure_servers(device, args, source_address=None, session=None):
+    """
+    --servers N: test the N best servers at the same time, each with its own
+    speedtest client and worker threads, and return a row per server plus
+    the aggregate row. With a measure() session, the clients are kept in it.
+    """
+    import concurrent.futures
+
+    s = _session_client(session, source_address) if session is not None else new_client(source_address)
+    servers = rank_servers(s, args.servers)
+    clients = session["server_clients"] if session is not None else []
+    clients += [None] * (len(servers) - len(clients))
+    rows = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(servers)) as pool:
+        futures = [pool.submit(_measure_server, device, args, source_address, srv, clients, i)
+                   for i, srv in enumerate(servers)]
+        for srv, fut in zip(servers, futures):
+            try:
+                rows.append(fut.result())
+            except Exception as e:
+                print(f"Speedtest against server {srv.get('id')} failed: {e}")
+    if not rows:
+        raise RuntimeError("all servers failed")
+    return rows + [aggregate_row(rows)]
+
+async def measure_servers_async(device, args, source_address=None, s=None):
+    """measure_servers() with the asyncio engine: every server in one event loop, sharing one client."""
+    import asyncio
+    import speedtest
+
+    if s is None:
+        s = await asyncio.to_thread(new_client, source_address)
+    servers = await _rank_servers_async(s, args.servers, source_address, speedtest.build_user_agent())
+
+    async def one(srv):
+        timings = {}
+        progress = {} if args.progress else None
+        row = await run_speedtest_async(s, None, 0, source_address, timings, progress, args.progress_interval, srv,
+                                        args.tuning)
+        return _device_row(device, row, timings, progress)
+
+    rows = []
+    for srv, result in zip(servers, await asyncio.gather(*(one(srv) for srv in servers), return_exceptions=True)):
+        if isinstance(result, Exception):
+            print(f"Speedtest against server {srv.get('id')} failed: {result}")
+        else:
+            rows.append(result)
+    if not rows:
+        raise RuntimeError("all servers failed")
+    return rows + [aggregate_row(rows)]
+
+def measure(device, args, session=None):
+    """
+    Measure device with the options parsed into args and return its rows,
+    device first, timings and any progress series included: one row, or
+    with --servers N, a row per server and an aggregate row. Passing the
+    same session dict on every call keeps one speedtest client, with its
+    config and server list, alive between measurements.
+    """
+    source_address = args.device_settings.get(device, {}).get("source_address")
+    if args.servers > 1:
+        try:
+            if args.engine == "asyncio":
+                import asyncio
+
+                s = _session_client(session, source_address) if session is not None else None
+                return asyncio.run(measure_servers_async(device, args, source_address, s))
+            return measure_servers(device, args, source_address, session)
+        except Exception:
+            if session is not None:
+                session.pop("client", None)
+            raise
+    timings = {}
+    progress = {} if args.progress else None
+    s = _session_client(session, source_address, timings) if session is not None else None
+    options = (args.server_cache, args.server_cache_ttl, source_address, timings, progress, args.progress_interval)
+    try:
+        if args.latency_only:
+            import asyncio
+
+            row = asyncio.run(run_latency_async(s, *options[:4], args.latency_samples, args.latency_rate))
+        elif args.engine == "asyncio":
+            import asyncio
+
+            row = asyncio.run(run_speedtest_async(s, *options, tuning=args.tuning))
+        else:
+            row = run_speedtest(s, *options, tuning=args.tuning)
+    except Exception:
+        if session is not None:
+            session.pop("client", None)  # start over with fresh config next time
+        raise
+    return [_device_row(device, row, timings, progress)]
+
+async def measure_async(device, args):
+    """measure() for the running event loop, with the asyncio engine."""
+    source_address = args.device_settings.get(device, {}).get("source_address")
+    if args.servers > 1:
+        return await measure_servers_async(device, args, source_address)
+    timings = {}
+    if args.latency_only:
+        row = await run_latency_async(None, args.server_cache, args.server_cache_ttl, source_address, timings,
+                                      args.latency_samples, args.latency_rate)
+        return [_device_row(device, row, timings, None)]
+    progress = {} if args.progress else None
+    row = await run_speedtest_async(None, args.server_cache, args.server_cache_ttl, source_address, timings,
+                                    progress, args.progress_interval, tuning=args.tuning)
+    return [_device_row(device, row, timings, progress)]
+
+def save_rows(store, rows, args):
+    """Write rows to the store, and their timings and progress series to the JSON sidecars if requested."""
+    store.write_many(rows)
+    if args.timings_json:
+        with open(args.timings_json, "a", encoding="utf-8") as f:
+            for row in rows:
+                f.write(json.dumps({fn: row.get(fn) for fn in ["device", "timestamp", *TIMING_FIELDS]}) + "\n")
+    if args.progress:
+        with open(args.progress, "a", encoding="utf-8") as f:
+            for row in rows:
+                for phase, samples in row.get("progress", {}).items():
+                    f.write(json.dumps({"device": row["device"], "timestamp": row["timestamp"], "phase": phase,
+                                        "interval": args.progress_interval, "samples": samples},
+                                       separators=(",", ":")) + "\n")
+    for row in rows:
+        print_result(store, row)
+
+# how many recent runs the --metrics-port exporter keeps in memory
+METRICS_HISTORY = 64
+# upper bounds, in seconds, of the phase duration histogram buckets
+METRICS_PHASE_BUCKETS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 15, 20, 30, 60]
+METRICS_PHASES = ["config", "server", "download", "upload"]
+METRICS_GAUGES = [("download_mbps", "Download throughput of the latest run, in Mbit/s"),
+                  ("upload_mbps", "Upload throughput of the latest run, in Mbit/s"),
+                  ("ping_ms", "Latency to the test server in the latest run, in ms"),
+                  ("latency_jitter_ms", "Round-trip jitter in the latest --latency-only run, in ms"),
+                  ("latency_p95_ms", "95th percentile round trip in the latest --latency-only run, in ms"),
+                  ("latency_loss_pct", "Share of probes lost in the latest --latency-only run, in percent")]
+
+def _metric_labels(**labels):
+    escaped = (str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for v in labels.values())
+    return "{" + ",".join(f'{k}="{v}"' for k, v in zip(labels, escaped)) + "}"
+
+class ResultMetrics:
+    """
+    In-memory view of a daemon's results for the /metrics endpoint: a ring
+    buffer of the last METRICS_HISTORY runs for the gauges, plus phase
+    duration histograms and failure counters that accumulate from start-up.
+    Scrapes render from memory and never touch the store.
+    """
+
+    def __init__(self, history=METRICS_HISTORY):
+        # one list of rows per run: a row per server plus any aggregate row
+        self.runs = collections.deque(maxlen=history)
+        # (device, phase) -> [bucket counts..., +Inf count, sum]
+        self.phases = {}
+        # (device, stage) -> count
+        self.failures = collections.Counter()
+        self.lock = threading.Lock()
+
+    def record(self, rows):
+        with self.lock:
+            # progress series can be large and aren't exported
+            self.runs.append([{k: v for k, v in row.items() if k != "progress"} for row in rows])
+            for row in rows:
+                for phase in METRICS_PHASES:
+                    seconds = row.get(f"{phase}_s")
+                    if seconds in (None, ""):
+                        continue
+                    hist = self.phases.setdefault((row["device"], phase), [0] * (len(METRICS_PHASE_BUCKETS) + 2))
+                    for i, bound in enumerate(METRICS_PHASE_BUCKETS):
+                        if seconds <= bound:
+                            hist[i] += 1
+                    hist[-2] += 1
+                    hist[-1] += seconds
+
+    def failure(self, device, stage):
+        with self.lock:
+            self.failures[device, stage] += 1
+
+    def latest(self):
+        """The rows of each device's most recent run, keyed by device."""
+        runs = {}
+        with self.lock:
+            for run in reversed(self.runs):
+                runs.setdefault(run[0]["device"], run)
+        return runs
+
+    def render(self, openmetrics=False):
+        """Text exposition format; openmetrics=True gives the OpenMetrics flavour."""
+        out = []
+        latest = self.latest()
+        for field, help_text in METRICS_GAUGES:
+            name = f"pidata_speedtest_{field}"
+            out += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge"]
+            for device, rows in latest.items():
+                for row in rows:
+                    if row.get(field) not in (None, ""):
+                        out.append(f"{name}{_metric_labels(device=device, server=row['server_id'])} {row[field]}")
+        name = "pidata_speedtest_last_run_timestamp_seconds"
+        out += [f"# HELP {name} When the latest run finished, in seconds since the epoch", f"# TYPE {name} gauge"]
+        for device, rows in latest.items():
+            out.append(f"{name}{_metric_labels(device=device)} {_parse_timestamp(rows[0]['timestamp']).timestamp()}")
+        with self.lock:
+            phases = {key: list(hist) for key, hist in self.phases.items()}
+            failures = dict(self.failures)
+        name = "pidata_speedtest_phase_duration_seconds"
+        out += [f"# HELP {name} Wall time of each measurement phase", f"# TYPE {name} histogram"]
+        for (device, phase), hist in sorted(phases.items()):
+            for bound, count in zip([*METRICS_PHASE_BUCKETS, "+Inf"], hist):
+                out.append(f"{name}_bucket{_metric_labels(device=device, phase=phase, le=bound)} {count}")
+            out.append(f"{name}_count{_metric_labels(device=device, phase=phase)} {hist[-2]}")
+            out.append(f"{name}_sum{_metric_labels(device=device, phase=phase)} {round(hist[-1], 3)}")
+        name = "pidata_speedtest_failures"
+        # OpenMetrics names the counter family without the _total suffix
+        family = name if openmetrics else f"{name}_total"
+        out += [f"# HELP {family} Failed measurements (stage=measure) and saves (stage=save)", f"# TYPE {family} counter"]
+        for (device, stage), count in sorted(failures.items()):
+            out.append(f"{name}_total{_metric_labels(device=device, stage=stage)} {count}")
+        if openmetrics:
+            out.append("# EOF")
+        return "\n".join(out) + "\n"
+
+def serve_metrics(metrics, host, port):
+    """
+    Serve metrics on http://host:port/metrics from a background thread and
+    return the server; server.shutdown() stops it.
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if urlsplit(self.path).path != "/metrics":
+                self.send_error(404)
+                return
+            openmetrics = "application/openmetrics-text" in self.headers.get("Accept", "")
+            body = metrics.render(openmetrics).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/openmetrics-text; version=1.0.0; charset=utf-8" if openmetrics
+                             else "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # one line every scrape would swamp the daemon log
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def run_daemon(device, store, args, jitter, metrics=None):
+    """
+    Measure every args.interval seconds until interrupted, reusing one
+    speedtest.Speedtest client. Ticks are scheduled from a fixed start so
+    slow runs don't make the schedule drift; ticks missed while a run
+    overran are skipped. Each tick is delayed by a random 0..jitter seconds
+    so a fleet started together doesn't hit the servers at once. Results
+    and failures also go to metrics, a ResultMetrics, if given.
+    """
+    import random
+    import sqlite3
+
+    interval = args.interval
+    session = {}
+    start = time.monotonic()
+    tick = 0
+    while True:
+        try:
+            rows = measure(device, args, session)
+        except Exception as e:
+            print(f"Speedtest failed: {e}", flush=True)
+            if metrics is not None:
+                metrics.failure(device, "measure")
+        else:
+            if metrics is not None:
+                metrics.record(rows)
+            try:
+                save_rows(store, rows, args)
+            except (OSError, sqlite3.Error) as e:
+                print(f"Saving results failed: {e}", flush=True)
+                if metrics is not None:
+                    metrics.failure(device, "save")
+
+        tick = max(tick + 1, int((time.monotonic() - start) // interval) + 1)
+        delay = start + tick * interval + random.uniform(0, jitter) - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+def measure_all_devices(devices, args):
+    """
+    Measure every device at once and return the rows of those that
+    succeeded: one worker process each, or with the asyncio engine, all in
+    one event loop. Writing is left to the caller so a single process owns
+    the store.
+    """
+    rows = []
+    if args.engine == "asyncio":
+        import asyncio
+
+        async def sweep():
+            return await asyncio.gather(*(measure_async(d, args) for d in devices), return_exceptions=True)
+
+        for d, result in zip(devices, asyncio.run(sweep())):
+            if isinstance(result, Exception):
+                print(f"Speedtest failed for {d}: {result}")
+            else:
+                rows.extend(result)
+        return rows
+
+    import concurrent.futures
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=len(devices)) as pool:
+        futures = {pool.submit(measure, d, args): d for d in devices}
+        for fut in concurrent.futures.as_completed(futures):
+            try:
+                rows.extend(fut.result())
+            except Exception as e:
+                print(f"Speedtest failed for {futures[fut]}: {e}")
+    # keep the configured device order in the output
+    rows.sort(key=lambda r: devices.index(r["device"]))
+    return rows
+
+def _size(text):
+    """argparse type for a byte size with an optional K, M or G suffix, e.g. 256K."""
+    item = text.strip().upper()
+    scale = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}.get(item[-1:], 1)
+    try:
+        size = int(float(item.rstrip("KMG")) * scale)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid size: {item!r}")
+    if size <= 0:
+        raise argparse.ArgumentTypeError(f"size must be positive: {item!r}")
+    return size
+
+def _rotation(text):
+    """argparse type for --rotate: "day" or a byte size."""
+    return "day" if text.strip().lower() == "day" else _size(text)
+
+def _size_list(text):
+    """argparse type for comma-separated byte sizes with optional K/M/G suffixes, e.g. 256K,1M,4M."""
+    return [_size(item) for item in text.split(",")]
+
+def _time_arg(text):
+    """argparse type for --since/--until: an ISO date or time, UTC unless it carries an offset."""
+    try:
+        return _utc_timestamp(_parse_timestamp(text))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid time: {text!r}")
+
+def query_main(argv):
+    """The query subcommand: print the logged rows that match the filters."""
+    parser = argparse.ArgumentParser(prog="pidata-speedtest.py query", description="Print logged results, filtered by device, time window and server.")
+    parser.add_argument("path", nargs="?", default=DEFAULT_OUTPUT, help=f"Results CSV (default: {DEFAULT_OUTPUT})")
+    parser.add_argument("--device", "-d", help="Only rows of this device")
+    parser.add_argument("--since", type=_time_arg, help="Only rows at or after this time, e.g. 2024-05-01 or 2024-05-01T12:00")
+    parser.add_argument("--until", type=_time_arg, help="Only rows before this time")
+    parser.add_argument("--server", help="Only rows of this server id")
+    parser.add_argument("--format", choices=["csv", "jsonl"], default="csv", help="Output format (default: csv)")
+    parser.add_argument("--limit", type=int, help="Stop after this many rows")
+    parser.add_argument("--latest", action="store_true", help="Only the most recent row of each device")
+    args = parser.parse_args(argv)
+
+    if args.latest:
+        latest = latest_results(args.path)
+        rows = [latest[d] for d in sorted(latest) if args.device is None or d == args.device]
+    else:
+        rows = iter_results(args.path, args.device, args.since, args.until, args.server)
+    writer = None
+    for i, row in enumerate(rows):
+        if args.limit is not None and i >= args.limit:
+            break
+        if args.format == "jsonl":
+            print(json.dumps(row))
+            continue
+        if writer is None:
+            # rows of segments from before a header migration lack some columns
+            writer = csv.DictWriter(sys.stdout, fieldnames=log_header(args.path) or list(row),
+                                    extrasaction="ignore", lineterminator="\n")
+            writer.writeheader()
+        writer.writerow(row)
+
+def stats_main(argv):
+    """The stats subcommand: print per-group summaries of the logged results."""
+    parser = argparse.ArgumentParser(prog="pidata-speedtest.py stats", description="Summarize logged download, upload and ping per device or server.")
+    parser.add_argument("path", nargs="?", default=DEFAULT_OUTPUT, help=f"Results CSV (default: {DEFAULT_OUTPUT})")
+    parser.add_argument("--by", choices=["device", "server", "device,server"], default="device", help="Group rows by device, server or both (default: device)")
+    parser.add_argument("--period", choices=list(STATS_PERIODS), default="all", help="Also group by UTC day, month or year (default: all)")
+    parser.add_argument("--device", "-d", help="Only rows of this device")
+    parser.add_argument("--since", type=_time_arg, help="Only rows at or after this time, e.g. 2024-05-01 or 2024-05-01T12:00")
+    parser.add_argument("--until", type=_time_arg, help="Only rows before this time")
+    parser.add_argument("--server", help="Only rows of this server id")
+    parser.add_argument("--format", choices=["table", "csv", "jsonl"], default="table", help="Output format (default: table)")
+    args = parser.parse_args(argv)
+
+    by = ["server_id" if c == "server" else c for c in args.by.split(",")]
+    try:
+        stats = compute_stats(args.path, by, args.period, args.device, args.since, args.until, args.server)
+    except ValueError as e:
+        print(e)
+        return
+    if args.format == "jsonl":
+        for row in stats:
+            print(json.dumps(row))
+    elif args.format == "csv" and stats:
+        writer = csv.DictWriter(sys.stdout, fieldnames=list(stats[0]), lineterminator="\n")
+        writer.writeheader()
+        writer.writerows(stats)
+    elif args.format == "table":
+        names = [" / ".join([*(str(row[c]) for c in by), row["period"]]) for row in stats]
+        width = max([len(n) for n in names] + [5])
+        print(f"{'group':<{width}}{'count':>8}  {'metric':<14}{'mean':>10}{'median':>10}{'p5':>10}{'p95':>10}{'p99':>10}")
+        for name, row in zip(names, stats):
+            for metric in STATS_METRICS:
+                values = [row[f"{metric}_{k}"] for k in ("mean", "median", "p5", "p95", "p99")]
+                print(f"{name:<{width}}{row['count']:>8}  {metric:<14}" + "".join(f"{v:>10.3f}" if v is not None else f"{'-':>10}" for v in values))
+
+def rollups_main(argv):
+    """The rollups subcommand: print the precomputed hourly or daily rollups."""
+    parser = argparse.ArgumentParser(prog="pidata-speedtest.py rollups", description="Print the hourly or daily rollups kept with --rollups, without reading the log.")
+    parser.add_argument("path", nargs="?", default=DEFAULT_OUTPUT, help=f"Results CSV (default: {DEFAULT_OUTPUT})")
+    parser.add_argument("--resolution", choices=list(ROLLUP_RESOLUTIONS), default="day", help="Bucket size (default: day)")
+    parser.add_argument("--device", "-d", help="Only buckets of this device")
+    parser.add_argument("--since", type=_time_arg, help="Only buckets from this time on, e.g. 2024-05-01")
+    parser.add_argument("--until", type=_time_arg, help="Only buckets before this time")
+    parser.add_argument("--rebuild", action="store_true", help="Recompute the rollups from the log first")
+    parser.add_argument("--format", choices=["table", "csv", "jsonl"], default="table", help="Output format (default: table)")
+    args = parser.parse_args(argv)
+
+    if args.rebuild:
+        with lock_file(args.path):
+            rebuild_rollups(args.path)
+    rows = read_rollups(args.path, args.resolution, args.device, args.since, args.until)
+    if args.format == "jsonl":
+        for row in rows:
+            print(json.dumps(row))
+    elif args.format == "csv" and rows:
+        writer = csv.DictWriter(sys.stdout, fieldnames=list(rows[0]), lineterminator="\n")
+        writer.writeheader()
+        writer.writerows(rows)
+    elif args.format == "table":
+        width = max([len(r["device"]) for r in rows] + [6])
+        print(f"{'device':<{width}}  {'bucket':<14}{'metric':<14}{'count':>7}{'mean':>10}{'min':>10}{'median':>10}{'p95':>10}{'max':>10}")
+        for r in rows:
+            print(f"{r['device']:<{width}}  {r['bucket']:<14}{r['metric']:<14}{r['count']:>7}"
+                  + "".join(f"{r[k]:>10.3f}" for k in ("mean", "min", "median", "p95", "max")))
+
+# subcommands, taken from the first argument before the measuring CLI parses it
+SUBCOMMANDS = {"query": query_main, "stats": stats_main, "rollups": rollups_main}
+
+def main():
+    if sys.argv[1:2] and sys.argv[1] in SUBCOMMANDS:
+        return SUBCOMMANDS[sys.argv[1]](sys.argv[2:])
+    devices = ["TUCMOTO5", "TUCMOTO2", "ZyXEL20522"]
+
+    parser = argparse.ArgumentParser(description="Run speedtest and append results to CSV.")
+    parser.add_argument("device_arg", nargs="?", help="Device number (1..N) or name (optional). Example: pidata-speedtest.py 1")
+    parser.add_argument("--output", "-o", default=DEFAULT_OUTPUT, help=f"CSV output path (default: {DEFAULT_OUTPUT})")
+    parser.add_argument("--device", "-d", choices=devices, help="Device name to record (if provided it takes precedence over positional arg)")
+    parser.add_argument("--all-devices", action="store_true", help="Measure every device at once, one process each")
+    parser.add_argument("--device-config", help="JSON file with per-device settings, e.g. {\"TUCMOTO5\": {\"source_address\": \"192.168.5.10\"}}")
+    parser.add_argument("--engine", choices=["threads", "asyncio"], default="threads", help="Measurement engine: speedtest's worker threads, or asyncio streams in one event loop (default: threads)")
+    parser.add_argument("--servers", type=int, default=1, help="Test the N best servers at the same time and add an aggregate row (default: 1)")
+    parser.add_argument("--threads", type=int, help="Transfer threads (connections with --engine asyncio) in both directions (default: from the speedtest config)")
+    parser.add_argument("--download-threads", type=int, help="Download threads; overrides --threads")
+    parser.add_argument("--upload-threads", type=int, help="Upload threads; overrides --threads")
+    parser.add_argument("--autotune", action="store_true", help=f"Pick each direction's thread count first, doubling it in {AUTOTUNE_TRIAL_S:g} s trials until throughput plateaus")
+    parser.add_argument("--max-threads", type=int, default=64, help="Upper limit for --autotune (default: 64)")
+    parser.add_argument("--download-sizes", help=f"Comma-separated download image sizes to request, from {','.join(map(str, DOWNLOAD_SIZES))} (default: all)")
+    parser.add_argument("--upload-sizes", type=_size_list, help="Comma-separated upload payload sizes in bytes, K/M suffixes allowed, e.g. 1M,4M,16M (default: from the speedtest config)")
+    parser.add_argument("--payload-count", type=int, help="Requests per payload size and direction (default: from the speedtest config)")
+    parser.add_argument("--duration", type=float, help="Max seconds per direction (default: from the speedtest config)")
+    parser.add_argument("--converge", type=float, nargs="?", const=0.05, metavar="SHARE",
+                        help=f"End each direction once the 95%% confidence interval of its throughput, over {CONVERGE_WINDOW_S:g} s windows after a {CONVERGE_WARMUP_S:g} s warm-up, is within SHARE of the mean (default SHARE: 0.05), and report that steady-state mean; --duration and --max-bytes still cap it")
+    parser.add_argument("--max-bytes", type=_size, help="End each direction once this many bytes, K/M/G suffixes allowed, have been moved (default: no limit)")
+    parser.add_argument("--pre-allocate", choices=["never", "always", "auto", "shared"], default="never",
+                        help=f"Upload payloads: never builds each one on first read, always builds them all before the upload starts (more memory, less CPU while timing), auto does so when they fit in {PRE_ALLOCATE_BUDGET // (1024 * 1024)} MiB, shared sends slices of one small read-only buffer (default: never)")
+    parser.add_argument("--latency-only", action="store_true", help="Only measure latency: probe the server over warm connections and record round-trip statistics, with no throughput test")
+    parser.add_argument("--latency-rate", type=float, default=10, help="Probes per second with --latency-only (default: 10)")
+    parser.add_argument("--latency-samples", type=int, default=100, help="Probes per --latency-only run (default: 100)")
+    parser.add_argument("--daemon", action="store_true", help="Keep running and measure every --interval seconds")
+    parser.add_argument("--interval", type=float, default=300, help="Seconds between measurements in --daemon mode (default: 300)")
+    parser.add_argument("--jitter", type=float, help="Max random delay added to each --daemon tick, in seconds (default: interval/10)")
+    parser.add_argument("--metrics-port", type=int, help="In --daemon mode, serve the latest results as Prometheus/OpenMetrics metrics on http://<metrics-host>:PORT/metrics")
+    parser.add_argument("--metrics-host", default="127.0.0.1", help="Address for --metrics-port to listen on (default: 127.0.0.1)")
+    parser.add_argument("--server-cache", help="Server list cache file (default: speedtest_servers.json next to the results)")
+    parser.add_argument("--server-cache-ttl", type=float, default=SERVER_CACHE_TTL, help=f"Seconds a cached server list stays valid; 0 disables the cache (default: {SERVER_CACHE_TTL})")
+    parser.add_argument("--timing-columns", action="store_true", help="Also store per-phase wall/CPU times, bytes and thread counts as extra columns")
+    parser.add_argument("--timings-json", help="Append per-phase timings as JSON lines to this sidecar file")
+    parser.add_argument("--progress", help="Append per-phase throughput time series ([seconds, bytes, Mbps] samples) as JSON lines to this file")
+    parser.add_argument("--progress-interval", type=float, default=0.1, help="Seconds between --progress samples (default: 0.1)")
+    parser.add_argument("--rollups", action="store_true", help="Keep hourly and daily rollups of CSV stores up to date in <csv>.rollups (see the rollups subcommand)")
+    parser.add_argument("--rotate", type=_rotation, metavar="day|SIZE", help="Close CSV stores into segments <stem>.<first timestamp><ext> once a day (day) or once they reach a size, K/M/G suffixes allowed; query, stats and rollups --rebuild read across them (default: never)")
+    parser.add_argument("--compress", choices=list(COMPRESSIONS), default="gzip", help="Compression of --rotate segments; zstd needs zstandard (default: gzip)")
+    parser.add_argument("--spool", help="Local spool directory: record results there at once and flush them to the stores in the background, keeping them until the stores take them, for results on a slow or intermittently mounted share")
+    parser.add_argument("--spool-batch", type=int, default=1, help="With --spool, flush once this many results are waiting (default: 1)")
+    parser.add_argument("--spool-timeout", type=float, default=SPOOL_TIMEOUT, help=f"With --spool, seconds to wait on exit for the flush; results not yet flushed stay spooled for the next run (default: {SPOOL_TIMEOUT:g})")
+    parser.add_argument("--store", action="append", help="Result store URL, e.g. sqlite:///results.db, parquet:///results or csv:///results.csv; repeat to write to several (default: CSV at --output)")
+    args = parser.parse_args()
+    if args.interval <= 0:
+        parser.error("--interval must be positive")
+    if args.jitter is not None and args.jitter < 0:
+        parser.error("--jitter can't be negative")
+    if args.servers < 1:
+        parser.error("--servers must be at least 1")
+    if args.progress_interval <= 0:
+        parser.error("--progress-interval must be positive")
+    if args.latency_only and args.servers > 1:
+        parser.error("--latency-only can't be combined with --servers")
+    if args.spool_timeout < 0:
+        parser.error("--spool-timeout can't be negative")
+    for name in ("spool_batch", "converge", "latency_rate", "latency_samples", "threads", "download_threads", "upload_threads", "max_threads", "payload_count", "duration"):
+        if getattr(args, name) is not None and getattr(args, name) <= 0:
+            parser.error(f"--{name.replace('_', '-')} must be positive")
+    download_sizes = None
+    if args.download_sizes:
+        try:
+            download_sizes = [int(n) for n in args.download_sizes.split(",")]
+        except ValueError:
+            download_sizes = []
+        if not download_sizes or set(download_sizes) - set(DOWNLOAD_SIZES):
+            parser.error(f"--download-sizes must be picked from {','.join(map(str, DOWNLOAD_SIZES))}")
+    args.tuning = {
+        "download_threads": args.download_threads or args.threads,
+        "upload_threads": args.upload_threads or args.threads,
+        "download_sizes": download_sizes,
+        "upload_sizes": args.upload_sizes,
+        "count": args.payload_count,
+        "duration": args.duration,
+        "converge": args.converge,
+        "max_bytes": args.max_bytes,
+        "pre_allocate": args.pre_allocate,
+        "autotune": args.autotune,
+        "max_threads": args.max_threads,
+    }
+    if args.all_devices and (args.device or args.device_arg or args.daemon):
+        parser.error("--all-devices can't be combined with a device selection or --daemon")
+    if args.metrics_port is not None and not args.daemon:
+        parser.error("--metrics-port needs --daemon")
+    try:
+        args.device_settings = load_device_config(args.device_config)
+    except (OSError, ValueError) as e:
+        print(f"Invalid device config: {e}")
+        return
+
+    # Determine device: --all-devices > --device flag > positional arg > interactive prompt
+    device = None
+    if args.all_devices:
+        pass
+    elif args.device:
+        device = args.device
+    elif args.device_arg:
+        sel = args.device_arg.strip()
+        if sel.isdigit():
+            idx = int(sel)
+            if 1 <= idx <= len(devices):
+                device = devices[idx - 1]
+            else:
+                print(f"Invalid device number: {sel}. Must be between 1 and {len(devices)}.")
+                return
+        elif sel in devices:
+            device = sel
+        else:
+            print(f"Invalid device name: {sel}. Valid names: {', '.join(devices)}")
+            return
+    else:
+        device = choose_device_interactive(devices)
+
+    fieldnames = FIELDNAMES + TIMING_FIELDS if args.timing_columns else FIELDNAMES
+    if args.latency_only:
+        fieldnames = fieldnames + LATENCY_FIELDS
+    elif args.converge or args.max_bytes:
+        fieldnames = fieldnames + [fn for fn in EARLY_STOP_FIELDS if fn not in fieldnames]
+    urls = args.store or [args.output]
+    if args.spool:
+        # a bad --store still fails before the test runs
+        try:
+            for url in urls:
+                check_store(url, args.rotate, args.compress)
+        except ValueError as e:
+            print(e)
+            return
+
+        def open_stores(columns):
+            stores = [open_store(url, columns, args.rollups, args.rotate, args.compress) for url in urls]
+            return stores[0] if len(stores) == 1 else StoreGroup(stores)
+
+        # the stores are opened by the spool's flusher, so an unreachable
+        # share can't hold up the run; the server cache stays local too
+        store = SpooledStore(args.spool, open_stores, ", ".join(urls), fieldnames, args.spool_batch, args.spool_timeout)
+        cache_dir = args.spool
+    else:
+        # open the store first so a bad --store fails before the test runs
+        try:
+            stores = [open_store(url, fieldnames, args.rollups, args.rotate, args.compress) for url in urls]
+        except ValueError as e:
+            print(e)
+            return
+        store = stores[0] if len(stores) == 1 else StoreGroup(stores)
+        cache_dir = os.path.dirname(stores[0].location)
+
+    if not args.server_cache:
+        args.server_cache = os.path.join(cache_dir, "speedtest_servers.json")
+
+    try:
+        if args.all_devices:
+            rows = measure_all_devices(devices, args)
+            if rows:
+                save_rows(store, rows, args)
+            return
+
+        if args.daemon:
+            jitter = args.interval / 10 if args.jitter is None else args.jitter
+            metrics = exporter = None
+            if args.metrics_port is not None:
+                metrics = ResultMetrics()
+                try:
+                    exporter = serve_metrics(metrics, args.metrics_host, args.metrics_port)
+                except OSError as e:
+                    print(f"Can't serve metrics on {args.metrics_host}:{args.metrics_port}: {e}")
+                    return
+                host, port = exporter.server_address[:2]
+                print(f"Serving metrics on http://{host}:{port}/metrics", flush=True)
+            try:
+                run_daemon(device, store, args, jitter, metrics)
+            except KeyboardInterrupt:
+                pass
+            finally:
+                if exporter is not None:
+                    exporter.shutdown()
+            return
+
+        try:
+            rows = measure(device, args)
+        except Exception as e:
+            print(f"Speedtest failed: {e}")
+            return
+        save_rows(store, rows, args)
+    finally:
+        store.close()
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file